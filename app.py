@@ -1,5 +1,7 @@
-from flask import Flask, Response, jsonify
-import redis
-from neomodel import StructuredNode, StringProperty, config, UniqueProperty
+from harmonic_take_home import create_app, warm_up
 
-from harmonic_take_home import app
+#`flask run` finds `app` here, and so can a WSGI server. Under a pre-fork
+#server, load it once in the parent so the workers share it, e.g.
+#   gunicorn --preload --workers 8 --bind :5001 app:app
+app = create_app()
+warm_up(app)
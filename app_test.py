@@ -1,16 +1,34 @@
 import pytest
+import asyncio
+import gzip
 import json
+import os
 import time
 import datetime
-from neomodel import db, UniqueProperty
-from harmonic_take_home import create_app
-from harmonic_take_home.models import Company, Person, Employment, Acquisition
+from neomodel import config, db, UniqueProperty
+from neo4j.exceptions import TransientError
+from harmonic_take_home import create_app, redis_conn, repository, models
+from harmonic_take_home.models import (Company, Person, Employment, Acquisition, install_schema, employment_period, cypher_query,
+                                       drop_inherited_driver, inherited_drivers, read_query, transaction)
+from harmonic_take_home.streams import StreamConsumer, ensure_consumer_group, DEAD_LETTER_STREAM
+from harmonic_take_home.worker import IngestWorker, ingest_health
+from harmonic_take_home.async_api import AsyncReadAPI
+from harmonic_take_home.changes import ChangeLog, ChangesExpired
+from harmonic_take_home.ingest import add_listener, required_listeners
+import argparse
+from bulk_loader import iter_json_array, Checkpoint, load_phase
+from harmonic_take_home.batch_writer import BatchWriter, PartitionedWriter
 
-from harmonic_take_home.routes import message_handler
+from harmonic_take_home.replica import ReplicaGraph, Replica, ReplicaUnavailable
+from harmonic_take_home.repository import Neo4jRepository
+from harmonic_take_home.sqlite_repository import SQLiteRepository
+from harmonic_take_home.routes import message_handler, response_cache, replica
+from harmonic_take_home.connections import Lazy
 
 @pytest.fixture(scope="module")
 def test_app():
-    app, _ = create_app()
+    app = create_app({'TESTING': True})
+    install_schema()
     with app.app_context():
         yield app  # this allows for teardown or cleanup after tests run
 
@@ -126,6 +144,11 @@ def test_people_bulk_create(client):
     person_count = get_person_count()
     assert person_count == 2
 
+def test_people_bulk_create_is_idempotent(client):
+    bulk_create_people()
+    bulk_create_people()
+    assert get_person_count() == 2
+
 def bulk_create_employments():
     #Note, we need people and companies to exist
     #To create employments
@@ -164,6 +187,12 @@ def test_employments_bulk_create(client):
     company = Company.nodes.get(company_id=3979242)
     assert(len(company.get_employees()) == 0)
 
+def test_employments_bulk_create_is_idempotent(client):
+    bulk_create_employments()
+    bulk_create_employments()
+    company = Company.nodes.get(company_id=6792948)
+    assert(len(company.get_employees()) == 2)
+
 def bulk_create_acquisitions():
     bulk_create_companies()
     acquisitions_data = [
@@ -185,6 +214,25 @@ def test_acquisitions_bulk_create(client):
     assert len(company.get_acquired_companies()) == 1
     assert len(company.get_all_descendant_companies()) == 2
 
+def test_company_keyset_pages(client):
+    bulk_create_companies()
+    first_page = Company.get_page(limit=2)
+    assert [c['company_id'] for c in first_page] == [703504, 3979242]
+    second_page = Company.get_page(after=first_page[-1]['company_id'], limit=2)
+    assert [c['company_id'] for c in second_page] == [6792948]
+    assert [c['company_id'] for c in Company.stream_all()] == [703504, 3979242, 6792948]
+    # A limit below 1 is clamped, and stream only takes json/ndjson
+    assert [c['company_id'] for c in client.get('/companies?limit=-1').get_json()['data']] == [703504]
+    # Not the whole listing
+    assert client.get('/companies?after=abc').status_code == 400
+    assert client.get('/companies?stream=false').status_code == 400
+
+def test_person_keyset_pages(client):
+    bulk_create_people()
+    assert Person.get_page(limit=1) == [{'person_id': 360027}]
+    assert Person.get_page(after=360027, limit=1) == [{'person_id': 3676157}]
+    assert Person.get_page(after=3676157) == []
+
 #Test methods on Company
 def test_company_get_employees_method(client):
     bulk_create_employments() #Initiates companies, people & employments
@@ -199,11 +247,13 @@ def test_company_get_employees_method(client):
     #Test that if employee hired twice, they show up twice in get_employees
     #But, they have the same id both times
     employee = employees[0]['person']
-    employee.employed_at.connect(company, {
+    employment = employee.employed_at.connect(company, {
         'employment_title': 'Chief Happiness Officer',
         'start_date': datetime.datetime.strptime('2020-01-01 00:00:00', "%Y-%m-%d %H:%M:%S"),
         'end_date': None
     })
+    # Stored on the relationship too, for the point in time queries' index
+    assert employment.company_id == 6792948
     updated_employees = company.get_employees()
     assert len(updated_employees) == 3
     updated_ids = set(map(lambda e: e['person'].person_id, updated_employees))
@@ -241,6 +291,86 @@ def test_company_get_all_ancestor_companies(client):
     assert len(ancestor_companies) == 2
     ancestor_company_ids = map(lambda c: c.company_id, ancestor_companies)
 
+def get_closure_depths():
+    query = """
+    MATCH (a:Company)-[t:ACQUIRED_TRANSITIVE]->(d:Company)
+    RETURN a.company_id, d.company_id, t.depth
+    """
+    results, meta = db.cypher_query(query)
+    return set((row[0], row[1], row[2]) for row in results)
+
+def test_acquisition_closure_depths(client):
+    bulk_create_acquisitions() #Will also create companies
+    expected = set([
+        (3979242, 703504, 1),
+        (3979242, 6792948, 2),
+        (703504, 6792948, 1)])
+    assert get_closure_depths() == expected
+    company = Company.nodes.get(company_id=3979242)
+    descendant_ids = [c.company_id for c in company.get_all_descendant_companies()]
+    assert descendant_ids == [703504, 6792948] # Closest first
+
+    #Rebuilding from scratch gives the same closure
+    db.cypher_query("MATCH ()-[t:ACQUIRED_TRANSITIVE]->() DELETE t")
+    assert get_closure_depths() == set()
+    Acquisition.rebuild_closure()
+    assert get_closure_depths() == expected
+
+def test_company_get_company_data(client):
+    bulk_create_acquisitions() #Will also create companies
+    sections = ['parent', 'ancestors', 'acquisitions', 'descendants']
+    company_data = Company.get_company_data([6792948, 1, 3979242], sections)
+    # Unknown ids are skipped, the rest keep their order
+    assert [data['company']['company_id'] for data in company_data] == [6792948, 3979242]
+
+    leaf, root = company_data
+    assert leaf['parent']['company_id'] == 703504
+    assert [c['company_id'] for c in leaf['ancestors']] == [703504, 3979242]
+    assert leaf['acquisitions'] == []
+    assert leaf['descendants'] == []
+    assert root['parent'] == None
+    assert [c['company_id'] for c in root['acquisitions']] == [703504]
+    assert [c['company_id'] for c in root['descendants']] == [703504, 6792948]
+
+    # Only the requested sections come back
+    company_data = Company.get_company_data([3979242], ['acquisitions'])
+    assert set(company_data[0].keys()) == set(['company', 'acquisitions'])
+
+def test_company_routes_reject_non_numeric_ids(client):
+    assert client.get('/company/abc').status_code == 400
+    assert client.post('/companies/lookup', json={'company_ids': [3979242, 'abc']}).status_code == 400
+
+def test_company_chains_are_bounded(client):
+    bulk_create_acquisitions() #Will also create companies
+    root = Company.get_company_data([3979242], ['descendants'], max_depth=1)[0]
+    assert [c['company_id'] for c in root['descendants']] == [703504]
+    assert root['truncated'] == ['descendants']
+    leaf = Company.get_company_data([6792948], ['ancestors', 'descendants'], limit=1)[0]
+    assert [c['company_id'] for c in leaf['ancestors']] == [703504]
+    assert leaf['truncated'] == ['ancestors']
+    assert Company.get_company_data([6792948], ['ancestors'])[0]['truncated'] == []
+
+    response = client.get('/company/6792948?ancestors=true&max_depth=1')
+    assert [c['company_id'] for c in response.get_json()['ancestors']] == [703504]
+    assert response.get_json()['truncated'] == ['ancestors']
+    assert client.get('/company/6792948?ancestors=true&limit=all').status_code == 400
+
+def test_acquisition_cycles_are_rejected(client):
+    bulk_create_acquisitions() #Will also create companies
+    before = get_closure_depths()
+    cycles = [
+        {"parent_company_id": 6792948, "acquired_company_id": 3979242, "merged_into_parent_company": False},
+        {"parent_company_id": 703504, "acquired_company_id": 703504, "merged_into_parent_company": False}]
+    assert Acquisition.bulk_create(cycles) == cycles
+    assert get_closure_depths() == before
+    # Cycles made within one batch are caught too, the later acquisition is rejected
+    Company.bulk_create([{"company_id": 1, "company_name": "Cycle Co", "headcount": 1}])
+    batch = [
+        {"parent_company_id": 6792948, "acquired_company_id": 1, "merged_into_parent_company": False},
+        {"parent_company_id": 1, "acquired_company_id": 3979242, "merged_into_parent_company": False}]
+    assert Acquisition.bulk_create(batch) == batch[1:]
+    assert Company.get_company_data([1], ['ancestors'])[0]['truncated'] == []
+
 def test_person_get_empoloyees_in_companies(client):
     bulk_create_employments() #Creates people/companies/employments
     company = Company.nodes.get(company_id=6792948)
@@ -256,6 +386,75 @@ def test_person_get_past_employees_in_companies(client):
     company = Company.nodes.get(company_id=6792948)
     assert len(Person.get_past_employees_in_companies([6792948, 703504])) == 2
 
+def test_person_get_employment_rows_in_companies(client):
+    bulk_create_employments() #Creates people/companies/employments
+    rows = Person.get_employment_rows_in_companies([6792948, 703504])
+    assert len(rows) == 3
+    assert len(Person.get_employment_rows_in_companies([6792948, 703504], present=True)) == 1
+    assert len(Person.get_employment_rows_in_companies([6792948, 703504], past=True)) == 2
+    assert len(Person.get_employment_rows_in_companies([6792948, 703504], past=True, present=True)) == 3
+    # Same rows as the inflate path
+    inflated = Person.get_employees_in_companies([6792948, 703504])
+    inflated_data = [(p['person'].person_id, p['company_name'], p['employment_title']) for p in inflated]
+    assert sorted(inflated_data) == sorted((r.person_id, r.company_name, r.employment_title) for r in rows)
+
+def test_person_employees_in_company_families(client):
+    bulk_create_employments() #Creates people/companies/employments
+    Acquisition.bulk_create([
+        {"parent_company_id": 703504, "acquired_company_id": 6792948, "merged_into_parent_company": True},
+        {"parent_company_id": 3979242, "acquired_company_id": 703504, "merged_into_parent_company": False}])
+    assert len(Person.get_employment_rows_in_companies([3979242])) == 0
+    assert len(Person.get_employment_rows_in_companies([3979242], include_descendants=True)) == 3
+    assert len(Person.get_employment_rows_in_companies([3979242], present=True, include_descendants=True)) == 1
+    assert len(Person.get_employment_rows_in_companies([6792948], include_ancestors=True)) == 3
+    assert len(Person.get_employment_rows_in_companies([703504], include_descendants=True, include_ancestors=True)) == 3
+    assert len(Person.get_past_employees_in_companies([3979242], include_descendants=True)) == 2
+
+    response = client.get('/people?company_ids=[3979242]&include_descendants=true&present=true')
+    assert [row['person_id'] for row in response.get_json()] == [3676157]
+
+def test_employee_counts_follow_hires_edits_and_acquisitions(client):
+    bulk_create_employments() #Creates people/companies/employments
+    bulk_create_employments() #Replays don't count twice
+    company = Company.nodes.get(company_id=6792948)
+    assert (company.current_employee_count, company.past_employee_count) == (1, 1)
+
+    Acquisition.bulk_create([
+        {"parent_company_id": 703504, "acquired_company_id": 6792948, "merged_into_parent_company": True},
+        {"parent_company_id": 3979242, "acquired_company_id": 703504, "merged_into_parent_company": False}])
+    root = Company.nodes.get(company_id=3979242).to_dict()
+    assert (root['current_employee_count'], root['past_employee_count']) == (0, 0)
+    assert (root['family_current_employee_count'], root['family_past_employee_count']) == (1, 2)
+
+    # Ending the current employment moves it to past, all the way up the tree
+    Employment.bulk_edit([{"company_id": 6792948, "person_id": 3676157,
+                           "start_date": "2017-05-01 00:00:00", "end_date": "2023-05-01 00:00:00"}])
+    company_data = Company.get_company_data([3979242])[0]['company']
+    assert (company_data['family_current_employee_count'], company_data['family_past_employee_count']) == (0, 3)
+
+    counts = lambda: [(c.current_employee_count, c.past_employee_count,
+                       c.family_current_employee_count, c.family_past_employee_count)
+                      for c in Company.nodes.order_by('company_id')]
+    before = counts()
+    Company.rebuild_employee_counts()
+    assert counts() == before
+
+def test_person_employment_rows_in_period(client):
+    bulk_create_employments() #Creates people/companies/employments
+    company_ids = [6792948, 703504]
+    rows_in = lambda period: sorted((r.person_id, r.company_name) for r in
+                                    Person.get_employment_rows_in_companies(company_ids, period=period))
+    assert rows_in(employment_period(as_of="2011-01-01")) == [(360027, "MAVRK Studio")]
+    assert rows_in(employment_period(as_of="2018-01-01")) == [(360027, "Aimco Apartment Homes"), (3676157, "MAVRK Studio")]
+    assert len(rows_in(employment_period(start="2011-01-01", end="2013-01-01"))) == 2
+    assert rows_in(employment_period(start="2021-01-01")) == [(3676157, "MAVRK Studio")]
+    assert len(rows_in(employment_period(end="2030-01-01"))) == 3
+
+    response = client.get('/people?company_ids=[6792948]&as_of=2011-01-01')
+    assert [row['person_id'] for row in response.get_json()] == [360027]
+    assert client.get('/people?company_ids=[6792948]&as_of=yesterday').status_code == 400
+    assert client.get('/people?company_ids=[6792948]&from=2020-01-01&to=2019-01-01').status_code == 400
+
 def test_edit_employment(client):
     bulk_create_employments() #Creates people/companies/employments
     assert len(Person.get_current_employees_in_companies([6792948])) == 1
@@ -275,3 +474,545 @@ def test_edit_employment(client):
 		"start_date": "2012-05-01 00:00:00",
 	})
     assert Person.get_past_employees_in_companies([703504])[0]['employment_title'] == "Awesome Sauces"
+
+## TESTS FOR STREAM INGEST
+def test_stream_consumer_acks_only_handled_entries(client):
+    redis_conn.delete('test_stream')
+    handled = []
+    def handler(message):
+        handled.append(json.loads(message)['type'])
+        return json.loads(message)['type'] != 'broken'
+
+    consumer = StreamConsumer(redis_conn, handler, stream_name='test_stream', group_name='test_group', name='test_consumer')
+    ensure_consumer_group(redis_conn, 'test_stream', 'test_group')
+    redis_conn.xadd('test_stream', {'data': json.dumps({'type': 'companies', 'data': []})})
+    redis_conn.xadd('test_stream', {'data': json.dumps({'type': 'broken', 'data': []})})
+    acked = consumer.run_once()
+    assert handled == ['companies', 'broken']
+    assert len(acked) == 1
+    # The failed entry stays pending so it can be retried or reclaimed
+    assert redis_conn.xpending('test_stream', 'test_group')['pending'] == 1
+
+def test_batch_writer_merges_messages_and_keeps_type_order(client):
+    applied = []
+    def apply(data_type, records):
+        applied.append((data_type, len(records)))
+
+    writer = BatchWriter(apply=apply, batch_size=3, max_delay=60)
+    for i in range(4):
+        hire = {'company_id': 703504, 'person_id': i, 'employment_title': 'Title', 'start_date': '2020-01-01 00:00:00'}
+        writer.add(json.dumps({'type': 'person_employments', 'data': [hire]}), f'hire-{i}')
+    writer.add(json.dumps({'type': 'person_employments_edit', 'data': {'person_id': 0}}), 'edit-0')
+
+    # Only the hires reached the size limit; edits wait for their own limit
+    assert writer.flush_due() == ['hire-0', 'hire-1', 'hire-2', 'hire-3']
+    assert applied == [('person_employments', 3), ('person_employments', 1)]
+    assert writer.flush_all() == ['edit-0']
+    assert applied[-1] == ('person_employments_edit', 1)
+
+def test_stream_consumer_dead_letters_malformed_entries(client):
+    redis_conn.delete('test_stream', DEAD_LETTER_STREAM)
+    consumer = StreamConsumer(redis_conn, writer=BatchWriter(max_delay=60), stream_name='test_stream',
+                              group_name='test_group', name='test_consumer')
+    ensure_consumer_group(redis_conn, 'test_stream', 'test_group')
+    unknown_type = json.dumps({'type': 'mergers', 'data': []})
+    redis_conn.xadd('test_stream', {'data': 'not json'})
+    redis_conn.xadd('test_stream', {'data': unknown_type})
+    assert len(consumer.run_once()) == 2
+    assert [fields['data'] for _, fields in redis_conn.xrange(DEAD_LETTER_STREAM)] == ['not json', unknown_type]
+
+def test_batch_writer_holds_back_only_the_failing_message(client):
+    applied = []
+    def apply(data_type, records):
+        if any(record['headcount'] < 0 for record in records):
+            raise ValueError("headcount can't be negative")
+        applied.extend(record['company_id'] for record in records)
+
+    writer = BatchWriter(apply=apply, batch_size=4, max_delay=60)
+    for i in range(4):
+        company = {'company_id': i, 'company_name': f'Company {i}', 'headcount': -1 if i == 2 else 1}
+        writer.add(json.dumps({'type': 'companies', 'data': [company]}), f'company-{i}')
+    # The failing message isn't handed back, so only its entry stays pending
+    assert writer.flush_all() == ['company-0', 'company-1', 'company-3']
+    assert sorted(applied) == [0, 1, 3]
+
+def test_batch_writer_retries_deadlocks_before_splitting(client):
+    attempts = []
+    def apply(data_type, records):
+        attempts.append(len(records))
+        if len(attempts) < 3:
+            raise TransientError("Deadlock detected")
+
+    writer = BatchWriter(apply=apply, batch_size=4, max_delay=60)
+    for i in range(4):
+        company = {'company_id': i, 'company_name': f'Company {i}', 'headcount': 1}
+        writer.add(json.dumps({'type': 'companies', 'data': [company]}), f'company-{i}')
+    # The whole chunk is tried again, not bisected into single messages
+    assert writer.flush_all() == ['company-0', 'company-1', 'company-2', 'company-3']
+    assert attempts == [4, 4, 4]
+
+def test_batch_writer_retries_edits_that_arrive_before_their_hire(client):
+    bulk_create_companies()
+    hire = {"company_id": 3979242, "person_id": 1234, "employment_title": "Head Cheese",
+            "start_date": "2020-01-01 00:00:00"}
+    firing = {"company_id": 3979242, "person_id": 1234, "start_date": "2020-01-01 00:00:00",
+              "end_date": "2021-01-01 00:00:00"}
+    writer = BatchWriter(max_delay=60)
+    writer.add(json.dumps({'type': 'person_employments_edit', 'data': [firing]}), 'firing')
+    # Nothing to edit yet, so the entry isn't handed back to be acked
+    assert writer.flush_all() == []
+    writer.add(json.dumps({'type': 'person_employments', 'data': [hire]}), 'hire')
+    writer.add(json.dumps({'type': 'person_employments_edit', 'data': [firing]}), 'firing') # Redelivered
+    assert writer.flush_all() == ['hire', 'firing']
+    assert len(Person.get_current_employees_in_companies([3979242])) == 0
+
+def test_partitioned_writer_keeps_each_persons_writes_together(client):
+    applied = []
+    def apply(data_type, records):
+        if any(record.get('employment_title') == 'Broken' for record in records):
+            raise ValueError("can't write this one")
+        applied.append((data_type, sorted(record['person_id'] for record in records)))
+
+    writer = PartitionedWriter(partitions=2, apply=apply, max_delay=60)
+    hires = [{"company_id": 3979242, "person_id": i, "start_date": "2020-01-01 00:00:00"} for i in range(4)]
+    firing = dict(hires[1], end_date="2021-01-01 00:00:00")
+    writer.add(json.dumps({'type': 'person_employments', 'data': hires}), 'hires')
+    writer.add(json.dumps({'type': 'person_employments_edit', 'data': [firing]}), 'firing')
+    # A person's hire and edit land in the same partition, so they're written in order by one thread
+    assert writer.flush_all() == ['hires', 'firing']
+    assert sorted(applied) == [('person_employments', [0, 2]), ('person_employments', [1, 3]),
+                               ('person_employments_edit', [1])]
+
+    # A message is only handed back once every partition has committed its part,
+    # and edits wait while any partition's hires are failing
+    applied.clear()
+    writer.add(json.dumps({'type': 'person_employments', 'data': [hires[0], dict(hires[1], employment_title='Broken')]}), 'hires')
+    writer.add(json.dumps({'type': 'person_employments_edit', 'data': [hires[2]]}), 'edit')
+    assert writer.flush_all() == []
+    assert applied == [('person_employments', [0])]
+
+def test_ingest_worker_drains_on_stop(test_app):
+    redis_conn.delete('test_worker_stream')
+    config = dict(test_app.config, STREAM_NAME='test_worker_stream', STREAM_GROUP='test_group',
+                  STREAM_BLOCK_MS=100, WRITER_MAX_DELAY=60)
+    worker = IngestWorker(config, redis_conn, threads=2)
+    worker.start()
+    redis_conn.xadd('test_worker_stream', {'data': json.dumps({'type': 'companies', 'data': [
+        {"company_id": 3979242, "company_name": "Kaiser Permanente", "headcount": 12}]})})
+    time.sleep(0.5)
+    worker.heartbeat()
+    health = ingest_health(redis_conn, 'test_worker_stream', 'test_group', 30)
+    assert health['healthy']
+    assert health['pending'] == 1 # buffered, not written yet
+
+    # Stopping flushes the buffered write before acking it
+    worker.stop()
+    for thread in worker.threads:
+        thread.join()
+    assert redis_conn.xpending('test_worker_stream', 'test_group')['pending'] == 0
+    assert Company.nodes.get_or_none(company_id=3979242) is not None
+
+## TESTS FOR RESPONSE CACHE
+def test_ingest_invalidates_cached_responses(client):
+    bulk_create_companies()
+    for key, tag in [('/company/3979242', 'company:3979242'), ('/company/703504', 'company:703504')]:
+        body, epoch = response_cache.get(key)
+        response_cache.set(key, '{}', [tag], epoch)
+    assert response_cache.get('/company/3979242')[0] == b'{}' # Bodies are the bytes sent
+
+    # A hire only invalidates the responses that include its company
+    message_handler(json.dumps({'type': 'person_employments', 'data': [{
+        "company_id": 3979242,
+        "person_id": 1234,
+        "employment_title": "Head Cheese",
+        "start_date": "2020-01-01 00:00:00"
+    }]}))
+    assert response_cache.get('/company/3979242')[0] == None
+    assert response_cache.get('/company/703504')[0] == b'{}'
+
+def test_bulk_edit_employments(client):
+    bulk_create_employments() #Creates people/companies/employments
+    unmatched_edit = {
+        "company_id": 6792948,
+        "person_id": 3676157,
+        "start_date": "1999-01-01 00:00:00",
+        "end_date": "2023-05-01 00:00:00"
+    }
+    unmatched = Employment.bulk_edit([
+        {
+            "company_id": 6792948,
+            "person_id": 3676157,
+            "start_date": "2017-05-01 00:00:00",
+            "end_date": "2023-05-01 00:00:00"
+        },
+        unmatched_edit,
+        {
+            "company_id": 703504,
+            "person_id": 360027,
+            "employment_title": "Awesome Sauces",
+            "start_date": "2012-05-01 00:00:00",
+        }])
+    assert unmatched == [unmatched_edit]
+    assert len(Person.get_current_employees_in_companies([6792948])) == 0
+    assert Person.get_past_employees_in_companies([703504])[0]['employment_title'] == "Awesome Sauces"
+
+def test_message_handler_accepts_edit_lists(client):
+    bulk_create_employments() #Creates people/companies/employments
+    message_handler(json.dumps({'type': 'person_employments_edit', 'data': [{
+        "company_id": 6792948,
+        "person_id": 3676157,
+        "start_date": "2017-05-01 00:00:00",
+        "end_date": "2023-05-01 00:00:00"
+    }]}))
+    assert len(Person.get_current_employees_in_companies([6792948])) == 0
+
+## TESTS FOR BULK LOADER
+def test_bulk_loader_parses_arrays_incrementally(tmp_path):
+    data = [{"company_id": 1, "tags": ["a", "]"]}, 12345, 1.5e3, None]
+    path = tmp_path / 'data.json'
+    path.write_text(json.dumps(data, indent=1))
+    # Tiny blocks split every value somewhere
+    for block_size in [1, 3, 64]:
+        assert list(iter_json_array(str(path), block_size)) == data
+    # More whitespace after an item than fits in a block
+    for text, expected in [('[1,2' + ' ' * 100 + ']', [1, 2]),
+                           ('[{"a":1}' + '\n' * 70 + ',{"b":2}]', [{"a": 1}, {"b": 2}])]:
+        path.write_text(text)
+        for block_size in [1, 16, 1 << 20]:
+            assert list(iter_json_array(str(path), block_size)) == expected
+
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'), chunk_size=100)
+    for index in [0, 1, 2, 5]:
+        checkpoint.mark('companies', index)
+    checkpoint.save()
+    resumed = Checkpoint(str(tmp_path / 'checkpoint.json'), chunk_size=100)
+    assert [resumed.is_done('companies', index) for index in range(6)] == [True, True, True, False, False, True]
+    with pytest.raises(ValueError):
+        Checkpoint(str(tmp_path / 'checkpoint.json'), chunk_size=50)
+
+def test_bulk_loader_resumes_from_its_checkpoint(client, tmp_path):
+    companies = [{"company_id": 9100000 + i, "company_name": f"Bulk Loaded {i}", "headcount": i} for i in range(3)]
+    path = tmp_path / 'Companies.json'
+    path.write_text(json.dumps(companies))
+    args = argparse.Namespace(workers=2, report_interval=60, chunk_size=1, skip_listeners=True)
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'), chunk_size=1)
+    checkpoint.mark('companies', 0)
+    checkpoint.mark('companies', 2)
+    # Only the chunk that wasn't checkpointed is written
+    results = load_phase('companies', str(path), args, checkpoint)
+    assert (results['chunks'], results['skipped_chunks'], results['records']) == (1, 2, 1)
+    assert all(checkpoint.is_done('companies', index) for index in range(3))
+    assert repository.get_company_data([9100001])[0]['company']['company_name'] == "Bulk Loaded 1"
+
+## TESTS FOR CHANGE FEED
+def test_change_log_keeps_a_bounded_sequence(client):
+    redis_conn.delete('test_changes', 'test_changes:seq')
+    change_log = ChangeLog(redis_conn, stream_name='test_changes', max_len=2)
+    assert change_log.since(0) == []
+    assert [change_log.append('companies', [{'company_id': i}]) for i in range(3)] == [1, 2, 3]
+    assert [change['seq'] for change in change_log.since(1)] == [2, 3]
+    assert change_log.since(3) == []
+    # Change 1 has been trimmed, so a cursor at 0 can't catch up
+    with pytest.raises(ChangesExpired):
+        change_log.since(0)
+
+def test_changes_route_returns_committed_writes(client):
+    latest = client.get('/changes?since=0&limit=1').get_json()
+    since = latest['latest'] if 'latest' in latest else 0
+    message_handler(json.dumps({'type': 'companies', 'data': [
+        {"company_id": 3979242, "company_name": "PT Sing Aji Sentosa", "headcount": 10}]}))
+    body = client.get(f'/changes?since={since}').get_json()
+    assert [change['type'] for change in body['changes']] == ['companies']
+    assert body['next_since'] == since + 1 == body['latest']
+    assert client.get(f'/changes?since={since}&limit=-1').status_code == 200
+
+def test_writes_stay_pending_until_the_change_log_has_them(client):
+    def failing_append(data_type, records):
+        raise ConnectionError("Change log is down")
+    add_listener(failing_append, required=True)
+    try:
+        message = json.dumps({'type': 'companies', 'data': [
+            {"company_id": 3979242, "company_name": "PT Sing Aji Sentosa", "headcount": 10}]})
+        # Committed, but not handed back to be acked, so it's redelivered
+        assert not message_handler(message)
+        writer = BatchWriter(max_delay=60)
+        writer.add(message, 'company')
+        assert writer.flush_all() == []
+    finally:
+        required_listeners.remove(failing_append)
+
+## TESTS FOR SQLITE REPOSITORY
+@pytest.fixture
+def sqlite_repository(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / 'test.sqlite3'))
+    yield repository
+    repository.close()
+
+def load_repository(repository):
+    companies = [
+        {"company_id": 703504, "company_name": "Aimco Apartment Homes", "headcount": 3},
+        {"company_id": 6792948, "company_name": "MAVRK Studio", "headcount": 10},
+        {"company_id": 3979242, "company_name": "PT Sing Aji Sentosa", "headcount": 10}]
+    employments = [
+        {"company_id": 703504, "person_id": 360027, "employment_title": "Vice President",
+         "start_date": "2012-05-01 00:00:00", "end_date": "2020-06-01 00:00:00"},
+        {"company_id": 6792948, "person_id": 360027, "employment_title": "Infra & Ops",
+         "start_date": "2010-05-01 00:00:00", "end_date": "2011-06-01 00:00:00"},
+        {"company_id": 6792948, "person_id": 3676157, "employment_title": "Costumer Service",
+         "start_date": "2017-05-01 00:00:00", "end_date": None}]
+    acquisitions = [
+        {"parent_company_id": 703504, "acquired_company_id": 6792948, "merged_into_parent_company": True},
+        {"parent_company_id": 3979242, "acquired_company_id": 703504, "merged_into_parent_company": False}]
+    with repository.transaction():
+        repository.create_companies(companies)
+        repository.create_employments(employments)
+        repository.create_employments(employments) # Replays don't count twice
+        repository.create_acquisitions(acquisitions)
+    # The records are left as they came, for the listeners and the change feed
+    assert employments[0]['start_date'] == "2012-05-01 00:00:00"
+
+def test_sqlite_repository_matches_neo4j(client, sqlite_repository):
+    neo4j_repository = Neo4jRepository()
+    load_repository(neo4j_repository)
+    load_repository(sqlite_repository)
+    company_ids = [6792948, 1, 703504, 3979242]
+    sections = ['parent', 'ancestors', 'acquisitions', 'descendants']
+    rows = lambda rows: sorted((r.person_id, r.company_name, r.employment_title) for r in rows)
+    def assert_same():
+        for backend in [neo4j_repository, sqlite_repository]:
+            assert backend.get_company_data(company_ids, sections) == neo4j_repository.get_company_data(company_ids, sections)
+            assert backend.get_company_data(company_ids, sections, max_depth=1, limit=1) == \
+                neo4j_repository.get_company_data(company_ids, sections, max_depth=1, limit=1)
+            assert backend.company_page(after=703504, limit=1) == neo4j_repository.company_page(after=703504, limit=1)
+            assert list(backend.stream_people()) == list(neo4j_repository.stream_people())
+            assert backend.acquisition_chain_ids([6792948]) == {703504, 3979242, 6792948}
+            for filters in [{}, {'present': True}, {'past': True, 'include_descendants': True},
+                            {'include_ancestors': True, 'period': employment_period(as_of="2018-01-01")}]:
+                assert rows(backend.employment_rows([703504], **filters)) == rows(
+                    neo4j_repository.employment_rows([703504], **filters))
+    assert_same()
+
+    edits = [{"company_id": 6792948, "person_id": 3676157, "start_date": "2017-05-01 00:00:00", "end_date": "2023-05-01 00:00:00"},
+             {"company_id": 6792948, "person_id": 1, "start_date": "2017-05-01 00:00:00", "end_date": "2023-05-01 00:00:00"}]
+    cycle = [{"parent_company_id": 6792948, "acquired_company_id": 3979242, "merged_into_parent_company": False}]
+    for backend in [neo4j_repository, sqlite_repository]:
+        with backend.transaction():
+            assert backend.edit_employments(edits) == edits[1:]
+            assert backend.create_acquisitions(cycle) == cycle
+    assert_same()
+
+def test_sqlite_repository_rebuilds_counts(sqlite_repository):
+    load_repository(sqlite_repository)
+    root = sqlite_repository.get_company_data([3979242])[0]['company']
+    assert (root['family_current_employee_count'], root['family_past_employee_count']) == (1, 2)
+    before = list(sqlite_repository.stream_companies())
+    sqlite_repository.rebuild_employee_counts()
+    sqlite_repository.rebuild_acquisitions()
+    assert list(sqlite_repository.stream_companies()) == before
+
+def test_sqlite_repository_reconnects_after_fork(sqlite_repository):
+    load_repository(sqlite_repository)
+    inherited = sqlite_repository.connection()
+    sqlite_repository.after_fork()
+    assert sqlite_repository.connection() is not inherited
+    assert sqlite_repository.get_company_data([703504])[0]['company']['company_name'] == "Aimco Apartment Homes"
+
+def test_forked_child_drops_the_inherited_neo4j_driver(client):
+    cypher_query('test.connect', "RETURN 1")
+    parent_driver = db.driver
+    try:
+        drop_inherited_driver()
+        # Kept, so it isn't garbage collected and closed under the parent
+        assert db.driver is None and parent_driver in inherited_drivers
+        cypher_query('test.reconnect', "RETURN 1")
+        assert db.driver is not parent_driver
+    finally:
+        inherited_drivers.remove(parent_driver)
+        parent_driver.close()
+
+def test_timed_reads_see_their_transactions_writes(client, monkeypatch):
+    monkeypatch.setattr(models, 'query_timeout', 5)
+    results, meta = read_query('test.timed', "RETURN 1 AS one")
+    assert results == [[1]] and meta == ['one']
+    with transaction():
+        db.cypher_query("CREATE (:Company {company_id: 9200000, company_name: 'Uncommitted'})")
+        results, _ = read_query('test.timed', "MATCH (c:Company {company_id: 9200000}) RETURN c.company_name")
+        assert results == [['Uncommitted']]
+    db.cypher_query("MATCH (c:Company {company_id: 9200000}) DELETE c")
+
+## TESTS FOR STARTUP
+def test_async_api_leaves_the_app_config_alone(test_app):
+    import importlib
+    import harmonic_take_home.async_api as async_api
+    importlib.reload(async_api)
+    assert repository._config is test_app.config
+
+def test_connections_are_built_on_first_use(test_app):
+    built = []
+    lazy = Lazy('thing', lambda config: built.append(config['STORAGE_BACKEND']) or {'backend': config['STORAGE_BACKEND']})
+    with pytest.raises(RuntimeError):
+        lazy.get('backend')
+    lazy.init_app(test_app)
+    assert built == []
+    assert lazy.get('backend') == lazy.get('backend') == test_app.config['STORAGE_BACKEND']
+    assert built == [test_app.config['STORAGE_BACKEND']]
+
+## TESTS FOR COMPANY SEARCH
+def test_company_search_ranks_prefixes_and_typos(client):
+    bulk_create_companies()
+    names = lambda response: [match['company']['company_name'] for match in response.get_json()]
+    assert names(client.get('/companies/search?q=aimco%20apa')) == ["Aimco Apartment Homes"]
+    assert names(client.get('/companies/search?q=studio')) == ["MAVRK Studio"]
+    assert names(client.get('/companies/search?q=mavrik')) == ["MAVRK Studio"]
+    assert client.get('/companies/search?q=%20').status_code == 400
+    # New companies are searchable as soon as they're committed
+    message_handler(json.dumps({'type': 'companies', 'data': [
+        {"company_id": 1, "company_name": "Aimco Holdings", "headcount": 1}]}))
+    assert names(client.get('/companies/search?q=aimco&limit=1')) == ["Aimco Holdings"]
+
+def test_sqlite_company_search(sqlite_repository):
+    load_repository(sqlite_repository)
+    names = lambda query: [match['company']['company_name'] for match in sqlite_repository.search_companies(query)]
+    assert names("aimco apa") == ["Aimco Apartment Homes"]
+    assert names("aimko") == ["Aimco Apartment Homes"]
+    assert names("pt") == ["PT Sing Aji Sentosa"]
+    # Names with every trigram come first, names sharing any are only read for typos
+    assert names("mavrk studio") == ["MAVRK Studio"]
+    sqlite_repository.create_companies([{"company_id": 703504, "company_name": "Aimco Renamed", "headcount": 3}])
+    assert names("apartment") == []
+
+## TESTS FOR READ REPLICA
+def test_replica_graph_matches_neo4j(client):
+    bulk_create_employments() #Creates people/companies/employments
+    bulk_create_acquisitions()
+    graph = ReplicaGraph.from_repository(repository)
+    company_ids = [6792948, 1, 703504, 3979242]
+    sections = ['parent', 'ancestors', 'acquisitions', 'descendants']
+    rows = lambda rows: sorted((r.person_id, r.company_name, r.employment_title) for r in rows)
+    def assert_same():
+        assert graph.company_data(company_ids, sections) == Company.get_company_data(company_ids, sections)
+        assert graph.company_data(company_ids, sections, max_depth=1, limit=1) == \
+            Company.get_company_data(company_ids, sections, max_depth=1, limit=1)
+        for filters in [{}, {'present': True}, {'past': True, 'include_descendants': True},
+                        {'include_ancestors': True, 'period': employment_period(as_of="2018-01-01")}]:
+            assert rows(graph.employment_rows([703504], **filters)) == rows(
+                Person.get_employment_rows_in_companies([703504], **filters))
+    assert_same()
+
+    # Kept current by the same writes ingest applies
+    edit = [{"company_id": 6792948, "person_id": 3676157,
+             "start_date": "2017-05-01 00:00:00", "end_date": "2023-05-01 00:00:00"}]
+    message_handler(json.dumps({'type': 'person_employments_edit', 'data': edit}))
+    graph.apply('person_employments_edit', edit)
+    assert_same()
+
+def test_read_routes_served_from_replica(client):
+    bulk_create_acquisitions() #Will also create companies
+    expected = client.get('/company/703504?parent=true').get_json()
+    replica.enabled = True
+    try:
+        deadline = time.time() + 10
+        while not replica.is_current() and time.time() < deadline:
+            time.sleep(0.1)
+        response = client.get('/company/703504?parent=true')
+        assert response.get_json() == expected
+        assert int(response.headers['X-Replica-Seq']) == replica.seq
+        assert client.get('/company/1').status_code == 404
+        assert client.get('/replica/status').get_json()['companies'] == 3
+    finally:
+        replica.enabled = False
+
+def test_replica_reloads_and_stops_serving_once_dropped(client):
+    bulk_create_companies()
+    local = Replica(repository, ChangeLog(redis_conn), reload_interval=60)
+    local.pid = os.getpid() # No follower thread, the test drives it
+    assert local.current_age() is None
+    local.load()
+    local.synced_at = time.time()
+    assert local.current_age() is not None and not local.reload_due()
+    local.loaded_at -= 61
+    assert local.reload_due()
+    # Dropped after a read checked it was current, the read raises instead of hitting a missing graph
+    local.drop()
+    assert local.current_age() is None
+    with pytest.raises(ReplicaUnavailable):
+        local.company_data([703504])
+
+## TESTS FOR ENCODINGS AND ETAGS
+def test_read_routes_negotiate_encoding_and_etags(client):
+    bulk_create_companies()
+    plain = client.get('/company/3979242')
+    compressed = client.get('/company/3979242', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(compressed.get_data())) == plain.get_json()
+    # Each variant has its own tag
+    assert plain.headers['ETag'] != compressed.headers['ETag']
+
+    # Nothing committed since, so the client's copy is still current
+    not_modified = client.get('/company/3979242', headers={'If-None-Match': plain.headers['ETag']})
+    assert not_modified.status_code == 304
+    message_handler(json.dumps({'type': 'companies', 'data': [
+        {"company_id": 3979242, "company_name": "PT Sing Aji Sentosa", "headcount": 11}]}))
+    modified = client.get('/company/3979242', headers={'If-None-Match': plain.headers['ETag']})
+    assert modified.status_code == 200
+    assert modified.get_json()['company']['headcount'] == 11
+
+    # A window that runs up to now changes without any write, so it's never tagged
+    windowed = client.get('/people?company_ids=[3979242]&from=2020-01-01')
+    assert windowed.status_code == 200 and 'ETag' not in windowed.headers
+    assert 'ETag' in client.get('/people?company_ids=[3979242]&from=2020-01-01&to=2021-01-01').headers
+
+def test_read_routes_serve_msgpack(client):
+    msgpack = pytest.importorskip('msgpack')
+    bulk_create_companies()
+    response = client.get('/companies', headers={'Accept': 'application/msgpack'})
+    assert response.mimetype == 'application/msgpack'
+    assert msgpack.unpackb(response.get_data()) == client.get('/companies').get_json()
+
+## TESTS FOR ASYNC API
+def asgi_get(api, path, query_string=''):
+    #Runs one GET through the ASGI app, returns (status, json body)
+    sent = []
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+    async def send(message):
+        sent.append(message)
+    async def call():
+        await api({'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string.encode()}, receive, send)
+        await api.close()
+    asyncio.run(call())
+    return sent[0]['status'], json.loads(sent[1]['body'])
+
+def test_async_company_matches_flask_route(client):
+    bulk_create_acquisitions() #Will also create companies
+    api = AsyncReadAPI(config.DATABASE_URL)
+    query_string = 'parent=true&ancestors=true&acquisitions=true&descendants=true'
+    status, body = asgi_get(api, '/company/703504', query_string)
+    assert status == 200
+    assert body == client.get(f'/company/703504?{query_string}').get_json()
+    assert asgi_get(api, '/company/1')[0] == 404
+
+def test_async_people_chunks_company_ids(client):
+    bulk_create_employments() #Creates people/companies/employments
+    api = AsyncReadAPI(config.DATABASE_URL, people_chunk_size=1)
+    query_string = 'company_ids=[6792948, 703504]&present=true'
+    status, body = asgi_get(api, '/people', query_string)
+    assert status == 200
+    expected = client.get(f'/people?{query_string}').get_json()
+    key = lambda row: (row['person_id'], row['company_name'])
+    assert sorted(body, key=key) == sorted(expected, key=key)
+
+## TESTS FOR METRICS
+def test_metrics_endpoint_reports_queries_and_routes(client):
+    bulk_create_companies()
+    response = client.get('/company/3979242')
+    assert response.status_code == 200
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'neo4j_query_seconds_count{query="Company.get_company_data"}' in body
+    assert 'http_request_seconds_bucket{route="/company/<company_id>",method="GET",status="200",le="+Inf"}' in body
+    # Failed queries are timed and counted too
+    with pytest.raises(Exception):
+        cypher_query('test.broken', "RETURN nope")
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'neo4j_query_failures_total{query="test.broken"} 1' in body
+    assert 'neo4j_query_seconds_count{query="test.broken"} 1' in body
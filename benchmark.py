@@ -0,0 +1,140 @@
+import argparse
+import datetime
+import json
+import random
+import subprocess
+import time
+from harmonic_take_home import create_app
+from harmonic_take_home.routes import message_handler
+
+# Measures ingest records/sec through message_handler and the latency of
+# every route, and writes the results as json so runs can be compared
+# across commits. e.g.
+#   python data_generator.py --output-dir data/large
+#   python benchmark.py --data-dir data/large --output bench_results.json
+#
+# PLEASE NOTE -- ingest writes the dataset into the configured db
+
+INGEST_ORDER = [
+    ('companies', 'Companies.json'),
+    ('person_employments', 'PersonEmployment.json'),
+    ('company_acquisitions', 'CompanyAcquisition.json')
+]
+
+def percentile(sorted_values, p):
+    # Nearest rank
+    if not sorted_values:
+        return None
+    rank = max(0, int(round(p / 100 * len(sorted_values))) - 1)
+    return sorted_values[rank]
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else None,
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p95_ms': percentile(latencies, 95) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None
+    }
+
+def load(data_dir, file_name):
+    with open(f"{data_dir}/{file_name}") as f:
+        return json.load(f)
+
+def benchmark_ingest(data_dir, chunk_size):
+    results = {}
+    for data_type, file_name in INGEST_ORDER:
+        records = load(data_dir, file_name)
+        failures = 0
+        start = time.perf_counter()
+        for i in range(0, len(records), chunk_size):
+            message = json.dumps({'type': data_type, 'data': records[i:i + chunk_size]})
+            if not message_handler(message):
+                failures += 1
+        elapsed = time.perf_counter() - start
+        results[data_type] = {
+            'records': len(records),
+            'seconds': elapsed,
+            'records_per_second': len(records) / elapsed if elapsed else None,
+            'failed_messages': failures
+        }
+        print(f"ingest {data_type}: {len(records)} records, {results[data_type]['records_per_second']:.0f} records/s")
+    return results
+
+def route_requests(company_ids, rng, batch_size):
+    # (name, method, path, json body) -- one per benchmarked request
+    def some_ids(n):
+        return json.dumps(rng.sample(company_ids, min(n, len(company_ids))))
+    company_id = rng.choice(company_ids)
+    all_flags = 'parent=true&ancestors=true&acquisitions=true&descendants=true'
+    return [
+        ('GET /companies', 'GET', '/companies', None),
+        ('GET /companies?limit', 'GET', '/companies?limit=100', None),
+        ('GET /company/<id>', 'GET', f'/company/{company_id}', None),
+        ('GET /company/<id>?all flags', 'GET', f'/company/{company_id}?{all_flags}', None),
+        ('POST /companies/lookup', 'POST', '/companies/lookup', {
+            'company_ids': rng.sample(company_ids, min(batch_size, len(company_ids))),
+            'parent': True, 'descendants': True
+        }),
+        ('GET /people', 'GET', '/people', None),
+        ('GET /people?limit', 'GET', '/people?limit=100', None),
+        ('GET /people?company_ids', 'GET', f'/people?company_ids={some_ids(10)}', None),
+        ('GET /people?company_ids&present', 'GET', f'/people?company_ids={some_ids(10)}&present=true', None),
+        ('GET /people?company_ids&past', 'GET', f'/people?company_ids={some_ids(10)}&past=true', None)
+    ]
+
+def benchmark_routes(app, company_ids, requests_per_route, batch_size, seed):
+    rng = random.Random(seed)
+    client = app.test_client()
+    latencies = {}
+    errors = {}
+    for _ in range(requests_per_route):
+        for name, method, path, body in route_requests(company_ids, rng, batch_size):
+            start = time.perf_counter()
+            response = client.open(path, method=method, json=body)
+            response.get_data()
+            latencies.setdefault(name, []).append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors[name] = errors.get(name, 0) + 1
+
+    results = {}
+    for name, route_latencies in latencies.items():
+        results[name] = summarize(route_latencies)
+        results[name]['errors'] = errors.get(name, 0)
+        print(f"{name}: p50 {results[name]['p50_ms']:.1f}ms p95 {results[name]['p95_ms']:.1f}ms p99 {results[name]['p99_ms']:.1f}ms")
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True).strip()
+    except Exception:
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default='.')
+    parser.add_argument('--chunk-size', type=int, default=1000, help="records per ingest message")
+    parser.add_argument('--skip-ingest', action='store_true', help="only benchmark the routes")
+    parser.add_argument('--requests-per-route', type=int, default=200)
+    parser.add_argument('--lookup-batch-size', type=int, default=200, help="ids per POST /companies/lookup")
+    parser.add_argument('--cache', action='store_true', help="leave the response cache on")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+
+    app = create_app({'CACHE_ENABLED': args.cache})
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'params': vars(args)
+    }
+    if not args.skip_ingest:
+        results['ingest'] = benchmark_ingest(args.data_dir, args.chunk_size)
+
+    company_ids = [company['company_id'] for company in load(args.data_dir, 'Companies.json')]
+    results['routes'] = benchmark_routes(app, company_ids, args.requests_per_route, args.lookup_batch_size, args.seed)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
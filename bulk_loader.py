@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from neo4j.exceptions import TransientError
+from harmonic_take_home import create_app, repository
+from harmonic_take_home.ingest import apply_records, notify_applied
+
+# Loads a snapshot (Companies.json, PersonEmployment.json and
+# CompanyAcquisition.json) straight into the storage backend, e.g.
+#   python bulk_loader.py --data-dir data/large --chunk-size 2000 --workers 8
+#
+# - Files are parsed one record at a time, so memory stays flat however big
+#   they are, and are written in chunks of --chunk-size records, one
+#   transaction per chunk.
+# - Phases run in dependency order: all companies, then people and
+#   employments, then acquisitions. Chunks inside a phase are written by
+#   --workers threads (each with its own db connection). Acquisitions
+#   always use a single writer, since concurrent closure updates can't see
+#   each other's edges.
+# - Every committed chunk is recorded in --checkpoint. Rerunning the same
+#   command after an interruption skips them. Writes are upserts, so a chunk
+#   that was in flight when it stopped is just applied again.
+#
+# Unlike db_uploader.py this doesn't go through the Redis stream, so it
+# works without an ingest worker running
+
+PHASES = [
+    ('companies', 'Companies.json'),
+    ('person_employments', 'PersonEmployment.json'),
+    ('company_acquisitions', 'CompanyAcquisition.json')
+]
+SEQUENTIAL_PHASES = {'company_acquisitions'}
+
+def iter_json_array(path, block_size=1 << 20):
+    # Yields the items of a top level json array without loading the file
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        buffer = ''
+        pos = 0
+        eof = False
+        started = False
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer) and not started:
+                if buffer[pos] != '[':
+                    raise ValueError(f"{path} isn't a json array")
+                started = True
+                pos += 1
+                continue
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            decoded = False
+            if pos < len(buffer):
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                    # Only complete once the next , or ] is in the buffer --
+                    # a number cut off by the end of a block still decodes.
+                    # If only whitespace follows, another block is read
+                    after = end
+                    while after < len(buffer) and buffer[after] in ' \t\r\n':
+                        after += 1
+                    if after < len(buffer):
+                        decoded = buffer[after] in ',]'
+                        if not decoded:
+                            raise json.JSONDecodeError("Expecting ',' or ']'", buffer, after)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+            if decoded:
+                yield item
+                pos = end
+                continue
+            if eof:
+                raise ValueError(f"{path} ended before the array was closed")
+            block = f.read(block_size)
+            eof = not block
+            buffer = buffer[pos:] + block
+            pos = 0
+
+def iter_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def index_ranges(indexes):
+    # [start, end) ranges, so a checkpoint stays small for millions of chunks
+    ranges = []
+    for index in sorted(indexes):
+        if ranges and ranges[-1][1] == index:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return ranges
+
+class Checkpoint:
+    # {data_type: [indexes of committed chunks]}, plus the chunk size, since
+    # the indexes only mean something for the same chunking
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.done = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['chunk_size'] != chunk_size:
+                raise ValueError(f"{path} was written with --chunk-size {saved['chunk_size']}")
+            self.done = {data_type: set(index for start, end in ranges for index in range(start, end))
+                         for data_type, ranges in saved['done'].items()}
+        self.chunk_size = chunk_size
+
+    def is_done(self, data_type, index):
+        return index in self.done.get(data_type, ())
+
+    def mark(self, data_type, index):
+        self.done.setdefault(data_type, set()).add(index)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'chunk_size': self.chunk_size,
+                       'done': {data_type: index_ranges(indexes) for data_type, indexes in self.done.items()}}, f)
+        os.replace(tmp_path, self.path)
+
+def write_chunk(data_type, records, notify, retries=5):
+    # Concurrent chunks can deadlock on shared people/companies; Neo4j
+    # reports that as transient, so back off and try again
+    for attempt in range(retries):
+        try:
+            with repository.transaction():
+                apply_records(data_type, records)
+            break
+        except TransientError:
+            if attempt == retries - 1:
+                raise
+            time.sleep((2 ** attempt) * 0.1 * (1 + random.random()))
+    if notify:
+        # Raises if the change log append fails, so the chunk isn't
+        # checkpointed and a rerun writes and appends it again
+        notify_applied(data_type, records)
+    return len(records)
+
+class Progress:
+    def __init__(self, interval):
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.records = 0
+
+    def add(self, data_type, records, chunks_done, force=False):
+        self.records += records
+        now = time.perf_counter()
+        if force or now - self.last_report >= self.interval:
+            self.last_report = now
+            elapsed = now - self.start
+            print(f"{data_type}: {chunks_done} chunks, {self.records} records in {elapsed:.1f}s "
+                  f"({self.records / elapsed if elapsed else 0:.0f} records/s)")
+
+def load_phase(data_type, path, args, checkpoint):
+    workers = 1 if data_type in SEQUENTIAL_PHASES else args.workers
+    progress = Progress(args.report_interval)
+    chunks_done = 0
+    skipped = 0
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def collect(return_when):
+            nonlocal chunks_done
+            finished, _ = wait(in_flight, return_when=return_when)
+            for future in finished:
+                index = in_flight.pop(future)
+                records = future.result() # Raises if the chunk failed for good
+                checkpoint.mark(data_type, index)
+                chunks_done += 1
+                progress.add(data_type, records, chunks_done)
+            checkpoint.save()
+
+        for index, chunk in enumerate(iter_chunks(iter_json_array(path), args.chunk_size)):
+            if checkpoint.is_done(data_type, index):
+                skipped += 1
+                continue
+            # Only a couple of chunks per worker are parsed ahead, which is
+            # what keeps memory flat
+            if len(in_flight) >= workers * 2:
+                collect(FIRST_COMPLETED)
+            in_flight[executor.submit(write_chunk, data_type, chunk, not args.skip_listeners)] = index
+        while in_flight:
+            collect(FIRST_COMPLETED)
+
+    progress.add(data_type, 0, chunks_done, force=True)
+    elapsed = time.perf_counter() - progress.start
+    return {
+        'records': progress.records,
+        'chunks': chunks_done,
+        'skipped_chunks': skipped,
+        'seconds': elapsed,
+        'records_per_second': progress.records / elapsed if elapsed else None
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default='.')
+    parser.add_argument('--chunk-size', type=int, default=1000, help="records per transaction")
+    parser.add_argument('--workers', type=int, default=4, help="writer threads for companies and employments")
+    parser.add_argument('--checkpoint', default='bulk_load.checkpoint.json', help="where to record committed chunks")
+    parser.add_argument('--report-interval', type=float, default=5.0, help="seconds between progress lines")
+    parser.add_argument('--skip-listeners', action='store_true',
+                        help="don't invalidate caches or write the change feed, e.g. for a first load into an empty db")
+    args = parser.parse_args()
+
+    create_app() # Configures the repository, and the cache/change feed listeners
+    checkpoint = Checkpoint(args.checkpoint, args.chunk_size)
+    results = {}
+    for data_type, file_name in PHASES:
+        results[data_type] = load_phase(data_type, os.path.join(args.data_dir, file_name), args, checkpoint)
+    print(json.dumps(results, indent=2))
+    print(f"Done. Remove {args.checkpoint} before loading another snapshot")
@@ -0,0 +1,117 @@
+import argparse
+import datetime
+import json
+import os
+import random
+
+# Generates a synthetic dataset in the same shapes as Companies.json,
+# PersonEmployment.json and CompanyAcquisition.json, e.g.
+#   python data_generator.py --companies 100000 --employments-per-company 50 --output-dir data/large
+
+job_titles = [
+    'Software Engineer',
+    'Account Executive',
+    'Product Manager',
+    'Data Scientist',
+    'Recruiter',
+    'Customer Success Manager',
+    'Designer',
+    'Marketing Manager',
+    'Head of Sales',
+    'Chief Executive Officer'
+]
+name_words = [
+    'Acme', 'Blue', 'Bright', 'Cloud', 'Delta', 'Frontier', 'Global', 'Harbor',
+    'Apex', 'Lumen', 'North', 'Orbit', 'Pioneer', 'Quantum', 'River', 'Summit'
+]
+name_suffixes = ['Labs', 'Systems', 'Holdings', 'Studio', 'Group', 'Technologies', 'Partners', 'Inc']
+
+def date_string(dt):
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+def generate_companies(count, rng):
+    company_ids = rng.sample(range(1, count * 20), count)
+    # Names have to be unique, the index keeps them that way
+    return [{
+        "company_id": company_id,
+        "company_name": f"{rng.choice(name_words)} {rng.choice(name_suffixes)} {index}",
+        "headcount": rng.randint(1, 5000)
+    } for index, company_id in enumerate(company_ids)]
+
+def generate_acquisitions(companies, trees, depth, branching, rng):
+    # Builds `trees` acquisition trees, each `depth` levels below its root
+    # with `branching` acquisitions per company, for as long as there are
+    # companies left
+    company_ids = [company['company_id'] for company in companies]
+    rng.shuffle(company_ids)
+    acquisitions = []
+    for _ in range(trees):
+        if not company_ids:
+            break
+        level = [company_ids.pop()]
+        for _ in range(depth):
+            next_level = []
+            for parent_company_id in level:
+                for _ in range(branching):
+                    if not company_ids:
+                        break
+                    acquired_company_id = company_ids.pop()
+                    acquisitions.append({
+                        "parent_company_id": parent_company_id,
+                        "acquired_company_id": acquired_company_id,
+                        "merged_into_parent_company": rng.random() < 0.5
+                    })
+                    next_level.append(acquired_company_id)
+            level = next_level
+    return acquisitions
+
+def generate_employments(companies, per_company, jobs_per_person, current_ratio, rng):
+    total = len(companies) * per_company
+    person_count = max(1, int(total / jobs_per_person))
+    start = datetime.datetime(2000, 1, 1)
+    employments = []
+    for company in companies:
+        for _ in range(per_company):
+            start_date = start + datetime.timedelta(days=rng.randint(0, 365 * 23))
+            employment = {
+                "company_id": company['company_id'],
+                "person_id": rng.randint(1, person_count),
+                "employment_title": rng.choice(job_titles),
+                "start_date": date_string(start_date),
+                "end_date": None
+            }
+            if rng.random() >= current_ratio:
+                end_date = start_date + datetime.timedelta(days=rng.randint(30, 365 * 8))
+                employment["end_date"] = date_string(end_date)
+            employments.append(employment)
+    return employments
+
+def write_json(output_dir, file_name, data):
+    with open(os.path.join(output_dir, file_name), 'w') as f:
+        json.dump(data, f, indent=1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--companies', type=int, default=10000)
+    parser.add_argument('--employments-per-company', type=int, default=20)
+    parser.add_argument('--jobs-per-person', type=float, default=2.0, help="average employments per person")
+    parser.add_argument('--current-ratio', type=float, default=0.3, help="share of employments with no end_date")
+    parser.add_argument('--acquisition-trees', type=int, default=100)
+    parser.add_argument('--acquisition-depth', type=int, default=3)
+    parser.add_argument('--acquisition-branching', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-dir', default='data')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+    companies = generate_companies(args.companies, rng)
+    acquisitions = generate_acquisitions(
+        companies, args.acquisition_trees, args.acquisition_depth, args.acquisition_branching, rng)
+    employments = generate_employments(
+        companies, args.employments_per_company, args.jobs_per_person, args.current_ratio, rng)
+
+    write_json(args.output_dir, 'Companies.json', companies)
+    write_json(args.output_dir, 'PersonEmployment.json', employments)
+    write_json(args.output_dir, 'CompanyAcquisition.json', acquisitions)
+    print(f"Wrote {len(companies)} companies, {len(employments)} employments and {len(acquisitions)} acquisitions to {args.output_dir}")
@@ -4,6 +4,8 @@ import time
 import datetime
 
 redis_conn = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+# Must match STREAM_NAME in the app config
+stream_name = 'flask_stream'
 
 f = open("Companies.json")
 companies_data = json.load(f)
@@ -14,7 +16,7 @@ companies_create_data = {
 }
 
 stringified_data = json.dumps(companies_create_data)
-redis_conn.publish('flask_channel', stringified_data)
+redis_conn.xadd(stream_name, {'data': stringified_data})
 
 f = open("PersonEmployment.json")
 person_employments_data = json.load(f)
@@ -26,7 +28,7 @@ person_employments_create_data = {
 
 stringified_data = json.dumps(person_employments_create_data)
 restored_data = json.loads(stringified_data)
-redis_conn.publish('flask_channel', stringified_data)
+redis_conn.xadd(stream_name, {'data': stringified_data})
 
 f = open("CompanyAcquisition.json")
 company_acquisitions_data = json.load(f)
@@ -37,6 +39,6 @@ company_acquisitions_create_data = {
 }
 
 stringified_data = json.dumps(company_acquisitions_create_data)
-redis_conn.publish('flask_channel', stringified_data)
+redis_conn.xadd(stream_name, {'data': stringified_data})
 
 print("db_uploader finished")
@@ -0,0 +1,244 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from neo4j.exceptions import TransientError
+from harmonic_take_home import metrics, repository
+from harmonic_take_home.ingest import WRITE_ORDER, parse_message, apply_records, applied_records, notify_applied
+
+#Sits between the stream consumer and Neo4j. Records are buffered per
+#message type and written as one transaction per chunk, instead of one
+#transaction per message (the mimicker sends one hire per message).
+#
+#Each message is passed in with a token (the stream entry id), and a
+#token is only handed back once every record from its message has been
+#committed, so the consumer knows when it is safe to XACK
+class BatchWriter:
+    def __init__(self, apply=apply_records, batch_size=100, min_batch_size=10,
+                 max_batch_size=5000, batch_step=50, max_delay=0.5, target_latency=0.25, retries=5):
+        self.apply = apply
+        self.retries = retries
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_step = batch_step
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+        # (token, records) per buffered message
+        self.buffers = {data_type: [] for data_type in WRITE_ORDER}
+        self.buffered = {data_type: 0 for data_type in WRITE_ORDER}
+        self.oldest = {data_type: None for data_type in WRITE_ORDER}
+
+    def pending(self):
+        return sum(self.buffered.values())
+
+    def add(self, message, token=None):
+        #Returns the tokens that are already finished, which is only
+        #ever the case for messages that have nothing to write.
+        #Raises MalformedMessage for messages that can't be applied
+        data_type, records = parse_message(message)
+        metrics.ingest_messages.inc(type=data_type)
+        if not records:
+            return [token]
+        self.add_records(data_type, records, token)
+        return []
+
+    def add_records(self, data_type, records, token=None):
+        if not self.buffers[data_type]:
+            self.oldest[data_type] = time.time()
+        self.buffers[data_type].append((token, records))
+        self.buffered[data_type] += len(records)
+
+    def is_due(self, data_type, now):
+        if not self.buffers[data_type]:
+            return False
+        return (self.buffered[data_type] >= self.batch_size
+                or now - self.oldest[data_type] >= self.max_delay)
+
+    def flush_due(self):
+        now = time.time()
+        done = []
+        for data_type in WRITE_ORDER:
+            if self.is_due(data_type, now):
+                done.extend(self.flush(data_type))
+        return done
+
+    def flush_all(self):
+        done = []
+        for data_type in WRITE_ORDER:
+            done.extend(self.flush(data_type))
+        return done
+
+    def flush(self, data_type):
+        #Anything buffered for an earlier type has to be written first,
+        #otherwise an edit could be applied before the hire it edits.
+        #If an earlier write fails, later types are held back until the next flush
+        done = []
+        for flush_type in WRITE_ORDER[:WRITE_ORDER.index(data_type) + 1]:
+            committed, ok = self.flush_buffer(flush_type)
+            done.extend(committed)
+            if not ok:
+                break
+        return done
+
+    def flush_buffer(self, data_type):
+        #Writes the buffer in chunks of whole messages, so a message is never
+        #partly committed. Returns (tokens committed, whether all of them were)
+        messages = self.buffers[data_type]
+        self.buffers[data_type] = []
+        self.buffered[data_type] = 0
+        self.oldest[data_type] = None
+
+        done = []
+        ok = True
+        while messages:
+            size = 0
+            count = 0
+            while count < len(messages) and (count == 0 or size + len(messages[count][1]) <= self.batch_size):
+                size += len(messages[count][1])
+                count += 1
+            chunk, messages = messages[:count], messages[count:]
+            committed, chunk_ok = self.write(data_type, chunk)
+            done.extend(committed)
+            if not chunk_ok:
+                #Smaller transactions next time, in case the size was the problem
+                self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+                ok = False
+        return done, ok
+
+    def write(self, data_type, messages):
+        #One transaction for the messages. If it fails they're split in half
+        #and each half retried, down to single messages, so one bad record
+        #only holds back its own message. Messages that still fail aren't
+        #returned, so their entries stay pending and are redelivered, and
+        #dead lettered after max_deliveries. Messages with records apply
+        #couldn't apply yet (see apply_records) are held back the same way
+        records = [record for _, message_records in messages for record in message_records]
+        start = time.time()
+        try:
+            unapplied = self.commit(data_type, records)
+        except Exception as e:
+            print(e)
+            metrics.ingest_failures.inc(type=data_type)
+            if len(messages) == 1:
+                return [], False
+            middle = len(messages) // 2
+            first, first_ok = self.write(data_type, messages[:middle])
+            second, second_ok = self.write(data_type, messages[middle:])
+            return first + second, first_ok and second_ok
+        latency = time.time() - start
+        metrics.ingest_seconds.observe(latency, type=data_type)
+        metrics.ingest_records.observe(len(records), type=data_type)
+        self.adjust(latency, len(records))
+        try:
+            notify_applied(data_type, applied_records(records, unapplied))
+        except Exception as e:
+            #Committed, but e.g. the change log didn't get it. Not handing the
+            #messages back leaves their entries pending to be redelivered
+            print(f"Leaving {data_type} write pending, notifying it failed: {e}")
+            metrics.ingest_notify_failures.inc(type=data_type)
+            return [], True
+        unapplied_ids = set(map(id, unapplied))
+        return [token for token, message_records in messages
+                if not any(id(record) in unapplied_ids for record in message_records)], True
+
+    def commit(self, data_type, records):
+        #Partitions written at once can still deadlock on the count deltas of
+        #an ancestor company they share; Neo4j reports that as transient, so
+        #back off and try again before write splits the messages up
+        for attempt in range(self.retries):
+            try:
+                with repository.transaction():
+                    return self.apply(data_type, records) or []
+            except TransientError:
+                if attempt == self.retries - 1:
+                    raise
+                time.sleep((2 ** attempt) * 0.1 * (1 + random.random()))
+
+    def adjust(self, latency, chunk_size):
+        #AIMD on the commit latency: halve the batch when a commit is slow,
+        #add batch_step while commits of a full chunk stay well under target
+        if latency > self.target_latency:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        elif chunk_size >= self.batch_size and latency < self.target_latency / 2:
+            self.batch_size = min(self.max_batch_size, self.batch_size + self.batch_step)
+
+def partition_key(data_type, record):
+    #Records that have to be written in the order they arrived share a key:
+    #a person's hires and edits, and a company's updates. Acquisitions all
+    #share one, so each batch's cycle check sees every acquisition before it
+    match data_type:
+        case "person_employments" | "person_employments_edit":
+            return record.get('person_id')
+        case "companies":
+            return record.get('company_id')
+        case _:
+            return None
+
+#Splits records between `partitions` BatchWriters by partition_key and
+#flushes the partitions in parallel, one message type at a time in
+#WRITE_ORDER. Records with the same key always land in the same partition,
+#which is only ever flushed by one thread at a time, so they keep their
+#order however many threads write. Each partition thread has its own db
+#connection (neomodel's db is thread local).
+#
+#Takes the same calls as a BatchWriter. A message's token is handed back
+#once every partition that got some of its records has committed them
+class PartitionedWriter:
+    def __init__(self, partitions=1, **writer_settings):
+        self.writers = [BatchWriter(**writer_settings) for _ in range(partitions)]
+        self.max_delay = self.writers[0].max_delay
+        self.executor = ThreadPoolExecutor(max_workers=partitions, thread_name_prefix='ingest-partition')
+        # token -> partitions that haven't committed their part of it yet
+        self.remaining = {}
+
+    def pending(self):
+        return sum(writer.pending() for writer in self.writers)
+
+    def partition(self, data_type, record):
+        key = partition_key(data_type, record)
+        return 0 if key is None else hash(key) % len(self.writers)
+
+    def add(self, message, token=None):
+        data_type, records = parse_message(message)
+        metrics.ingest_messages.inc(type=data_type)
+        if not records:
+            return [token]
+        parts = {}
+        for record in records:
+            parts.setdefault(self.partition(data_type, record), []).append(record)
+        #A redelivered entry starts over, whatever happened to its first delivery
+        self.remaining[token] = len(parts)
+        for index, part in parts.items():
+            self.writers[index].add_records(data_type, part, token)
+        return []
+
+    def flush_due(self):
+        now = time.time()
+        due = [data_type for data_type in WRITE_ORDER if any(writer.is_due(data_type, now) for writer in self.writers)]
+        if not due:
+            return []
+        return self.flush_types(WRITE_ORDER[:WRITE_ORDER.index(due[-1]) + 1])
+
+    def flush_all(self):
+        return self.flush_types(WRITE_ORDER)
+
+    def flush_types(self, data_types):
+        #Like BatchWriter.flush, later types wait if any partition failed
+        #to write an earlier one
+        done = []
+        for data_type in data_types:
+            results = list(self.executor.map(lambda writer: writer.flush_buffer(data_type), self.writers))
+            for committed, _ in results:
+                done.extend(self.finished(committed))
+            if not all(ok for _, ok in results):
+                break
+        return done
+
+    def finished(self, tokens):
+        done = []
+        for token in tokens:
+            self.remaining[token] -= 1
+            if not self.remaining[token]:
+                del self.remaining[token]
+                done.append(token)
+        return done
@@ -0,0 +1,158 @@
+import functools
+import json
+import time
+from urllib.parse import urlencode
+import redis
+from flask import request, current_app, g
+from harmonic_take_home import repository
+from harmonic_take_home.encoding import response_variant, variant_name, build_response
+
+#Read-through cache for json responses, kept in the same Redis as the stream.
+#
+#Every cached response is tagged (e.g. 'company:703504'), and ingest
+#invalidates by tag once a write commits. Keys also expire after the TTL,
+#and once there are more than max_entries the least recently read ones
+#are evicted (tracked in a sorted set of last read times).
+#Bodies are stored as the bytes that were sent, one entry per encoding
+#variant, so the cache talks to Redis without decode_responses
+def binary_client(redis_conn):
+    pool = redis_conn.connection_pool
+    kwargs = dict(pool.connection_kwargs, decode_responses=False)
+    return redis.Redis(connection_pool=redis.ConnectionPool(connection_class=pool.connection_class, **kwargs))
+
+class ResponseCache:
+    def __init__(self, redis_conn, ttl=300, max_entries=10000, prefix='cache'):
+        self.text_redis_conn = redis_conn
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self.lru_key = f"{prefix}:lru"
+        # Bumped on every invalidation, see set()
+        self.epoch_key = f"{prefix}:epoch"
+
+    @functools.cached_property
+    def redis_conn(self):
+        #Made on first use, from the app's client once it's configured
+        return binary_client(self.text_redis_conn)
+
+    def make_key(self, path, args, variant='json'):
+        normalized = urlencode(sorted(args.items(multi=True)))
+        return f"{self.prefix}:{variant}:{path}?{normalized}"
+
+    def tag_key(self, tag):
+        return f"{self.prefix}:tag:{tag}"
+
+    def get(self, key):
+        #One round trip: the cached body, the current epoch, and the LRU touch
+        pipe = self.redis_conn.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.get(self.epoch_key)
+        pipe.zadd(self.lru_key, {key: time.time()}, xx=True)
+        body, epoch, _ = pipe.execute()
+        return body, epoch
+
+    def set(self, key, body, tags, epoch):
+        #If anything was invalidated since this response was read from the db,
+        #it may already be stale, so it isn't cached
+        if self.redis_conn.get(self.epoch_key) != epoch:
+            return
+        pipe = self.redis_conn.pipeline(transaction=False)
+        pipe.set(key, body, ex=self.ttl)
+        pipe.zadd(self.lru_key, {key: time.time()})
+        for tag in tags:
+            pipe.sadd(self.tag_key(tag), key)
+            pipe.expire(self.tag_key(tag), self.ttl)
+        pipe.zcard(self.lru_key)
+        size = pipe.execute()[-1]
+        if size > self.max_entries:
+            self.evict(size - self.max_entries)
+
+    def evict(self, count):
+        oldest = self.redis_conn.zpopmin(self.lru_key, count)
+        if oldest:
+            self.redis_conn.delete(*[key for key, _ in oldest])
+
+    def invalidate(self, tags):
+        tag_keys = [self.tag_key(tag) for tag in tags]
+        if not tag_keys:
+            return
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for tag_key in tag_keys:
+            pipe.smembers(tag_key)
+        keys = set().union(*pipe.execute())
+
+        pipe = self.redis_conn.pipeline(transaction=False)
+        pipe.incr(self.epoch_key)
+        pipe.delete(*tag_keys, *keys)
+        if keys:
+            pipe.zrem(self.lru_key, *keys)
+        pipe.execute()
+
+    def invalidate_for_write(self, data_type, records):
+        #Ingest listener -- works out which companies a committed write touched
+        match data_type:
+            case "person_employments" | "person_employments_edit":
+                #The employee counts change on the company and on its ancestors' families,
+                #and show up in every response that lists one of them
+                company_ids = repository.acquisition_chain_ids(list(set(record['company_id'] for record in records)))
+                tags = ['people'] if data_type == "person_employments" else []
+            case "company_acquisitions":
+                #Every ancestor gains descendants and every descendant gains ancestors
+                company_ids = set()
+                for record in records:
+                    company_ids.add(record['parent_company_id'])
+                    company_ids.add(record['acquired_company_id'])
+                company_ids = repository.acquisition_chain_ids(list(company_ids))
+                tags = []
+            case "companies":
+                #Replayed/updated companies show up in their relatives' responses too
+                company_ids = repository.acquisition_chain_ids([record['company_id'] for record in records])
+                tags = []
+            case _:
+                return
+        self.invalidate(tags + [f"company:{company_id}" for company_id in company_ids])
+
+def cached(response_cache, tags, unless=None):
+    #Caches the body of a view's 200 responses, per encoding variant. tags is
+    #called with the response data and the view's kwargs, and returns the
+    #tags to file it under. Requests for which unless() is true aren't cached
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config.get('CACHE_ENABLED', True) or (unless is not None and unless()):
+                return view(*args, **kwargs)
+            variant = response_variant()
+            key = response_cache.make_key(request.path, request.args, variant_name(variant))
+            body, epoch = response_cache.get(key)
+            if body is not None:
+                return build_response(body, variant)
+
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                data = g.response_data if 'response_data' in g else response.get_json()
+                response_cache.set(key, response.get_data(), tags(data, kwargs), epoch)
+            return response
+        return wrapper
+    return decorator
+
+def company_tags(company_data, view_kwargs):
+    #Every company that appears anywhere in a /company payload
+    company_ids = set()
+    for section, value in company_data.items():
+        if section == 'truncated':
+            continue
+        if isinstance(value, list):
+            company_ids.update(company['company_id'] for company in value)
+        elif isinstance(value, dict):
+            company_ids.add(value['company_id'])
+    return [f"company:{company_id}" for company_id in company_ids]
+
+def people_tags(people_data, view_kwargs):
+    if request.args.get('company_ids', False):
+        company_ids = json.loads(request.args['company_ids'])
+        if request.args.get('include_descendants', False) or request.args.get('include_ancestors', False):
+            # A hire anywhere in the family changes the response
+            company_ids = repository.acquisition_chain_ids(company_ids)
+        return [f"company:{company_id}" for company_id in company_ids]
+    # The list of everyone changes with every new hire
+    return ['people']
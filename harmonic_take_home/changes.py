@@ -0,0 +1,89 @@
+import functools
+import json
+
+#Change feed of every write ingest commits, for clients that want to sync
+#incrementally instead of re-polling the full lists.
+#
+#Each committed batch gets the next number from SEQ_KEY and is appended to
+#a capped Redis stream under the entry id "<seq>-0", so the stream is
+#ordered by seq and XRANGE/XREAD can start from any seq. Both happen in one
+#Lua script, so concurrent ingest workers can't interleave them.
+#Only the newest max_len changes are kept; a client whose cursor is older
+#than that gets ChangesExpired and has to start again from a full snapshot
+
+APPEND_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('XADD', KEYS[2], 'MAXLEN', ARGV[1], seq .. '-0', 'type', ARGV[2], 'data', ARGV[3])
+return seq
+"""
+
+class ChangesExpired(Exception):
+    def __init__(self, oldest):
+        super().__init__(f"Changes before {oldest} are no longer kept")
+        self.oldest = oldest
+
+def entry_seq(entry_id):
+    return int(entry_id.split('-')[0])
+
+def entry_change(entry_id, fields):
+    return {'seq': entry_seq(entry_id), 'type': fields['type'], 'data': json.loads(fields['data'])}
+
+class ChangeLog:
+    def __init__(self, redis_conn, stream_name='changes', max_len=100000):
+        self.redis_conn = redis_conn
+        self.stream_name = stream_name
+        self.max_len = max_len
+
+    @property
+    def seq_key(self):
+        return f"{self.stream_name}:seq"
+
+    @functools.cached_property
+    def append_script(self):
+        #Registered on first use rather than up front, which would make
+        #the Redis client before the app has configured it
+        return self.redis_conn.register_script(APPEND_SCRIPT)
+
+    def append(self, data_type, records):
+        return self.append_script(keys=[self.seq_key, self.stream_name],
+                                  args=[self.max_len, data_type, json.dumps(records)])
+
+    def record_applied(self, data_type, records):
+        #Ingest listener
+        self.append(data_type, records)
+
+    def latest(self):
+        return int(self.redis_conn.get(self.seq_key) or 0)
+
+    def check_cursor(self, since):
+        #Raises ChangesExpired if changes after `since` have already been trimmed
+        oldest = self.redis_conn.xrange(self.stream_name, count=1)
+        if oldest:
+            oldest_seq = entry_seq(oldest[0][0])
+            if since + 1 < oldest_seq:
+                raise ChangesExpired(oldest_seq)
+        elif since < self.latest():
+            raise ChangesExpired(self.latest() + 1)
+
+    def since(self, since, limit=1000):
+        #Up to `limit` changes after `since`, oldest first
+        self.check_cursor(since)
+        entries = self.redis_conn.xrange(self.stream_name, min=f"({since}-0", count=limit)
+        return [entry_change(entry_id, fields) for entry_id, fields in entries]
+
+    def follow(self, since, block_ms=15000, limit=1000):
+        #Yields lists of changes after `since` as they are appended, forever.
+        #An empty list means nothing arrived within block_ms
+        self.check_cursor(since)
+        last_id = f"{since}-0"
+        while True:
+            response = self.redis_conn.xread({self.stream_name: last_id}, count=limit, block=block_ms)
+            if not response:
+                yield []
+                continue
+            entries = response[0][1]
+            if entry_seq(entries[0][0]) > entry_seq(last_id) + 1:
+                #Fell behind by more than max_len while blocked
+                raise ChangesExpired(entry_seq(entries[0][0]))
+            last_id = entries[-1][0]
+            yield [entry_change(entry_id, fields) for entry_id, fields in entries]
@@ -0,0 +1,37 @@
+import click
+from flask import Blueprint, current_app
+from harmonic_take_home import redis_conn, repository
+from harmonic_take_home.worker import IngestWorker, serve_metrics
+
+#Run with `flask <command>`
+commands = Blueprint('commands', __name__, cli_group=None)
+
+@commands.cli.command('rebuild-acquisition-closure')
+def rebuild_acquisition_closure():
+    repository.rebuild_acquisitions()
+    click.echo("Rebuilt ACQUIRED_TRANSITIVE closure" if repository.name == 'neo4j' else "Recounted family rollups")
+
+@commands.cli.command('rebuild-employee-counts')
+def rebuild_employee_counts():
+    repository.rebuild_employee_counts()
+    click.echo("Recounted current/past employees and family rollups")
+
+@commands.cli.command('install-schema')
+def install_schema_command():
+    repository.install_schema()
+    click.echo("Installed constraints and indexes")
+
+@commands.cli.command('ingest-worker')
+@click.option('--threads', type=int, default=None, help="Writer threads, records are split between them by person/company. Defaults to INGEST_WORKER_THREADS")
+@click.option('--metrics-port', type=int, default=None, help="Serve /metrics for this process on this port")
+def ingest_worker_command(threads, metrics_port):
+    #Consumes the ingest stream until SIGTERM/SIGINT, then drains and exits
+    config = current_app.config
+    if metrics_port:
+        serve_metrics(metrics_port)
+    worker = IngestWorker(config, redis_conn,
+        threads=threads or config['INGEST_WORKER_THREADS'],
+        heartbeat_interval=config['INGEST_HEARTBEAT_INTERVAL'])
+    click.echo(f"Consuming {config['STREAM_NAME']} with {len(worker.consumers[0].writer.writers)} writer thread(s)")
+    worker.run()
+    click.echo("Ingest worker stopped")
@@ -0,0 +1,61 @@
+import os
+import threading
+import redis
+from harmonic_take_home.models import drop_inherited_driver
+from harmonic_take_home.repository import create_repository
+
+#The process-wide Redis client and storage repository.
+#
+#Both are stand-ins until something uses them: create_app only hands them
+#the app config, and the real client is built from it by whichever request,
+#command or thread needs it first. So importing the package or creating the
+#app doesn't open a connection, and a server that loads the app once and
+#forks its workers from it (e.g. gunicorn --preload) shares everything that
+#was imported and built, while each worker opens its own connections, see
+#after_fork
+
+class Lazy:
+    #Attributes are looked up on the real object, which is built on first use.
+    #Everything of its own is underscored so it can't hide one of them
+    def __init__(self, label, build):
+        self._label = label
+        self._build = build
+        self._config = None
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        with self._lock:
+            self._config = app.config
+            self._instance = None
+
+    def _resolve(self):
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                if self._instance is None:
+                    if self._config is None:
+                        raise RuntimeError(f"{self._label} used before create_app()")
+                    self._instance = self._build(self._config)
+                instance = self._instance
+        return instance
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+redis_conn = Lazy('redis_conn', lambda config: redis.Redis.from_url(config['REDIS_URL'], decode_responses=True))
+repository = Lazy('repository', create_repository)
+
+def after_fork():
+    #In a forked child, the parent's connections are sockets the parent is
+    #still using, so the repository and neomodel let go of them and open
+    #their own on first use. neomodel's is dropped even if the repository
+    #was never resolved, since the models can be used without it. Redis
+    #connection pools already do this themselves when they see the pid change
+    for lazy in (redis_conn, repository):
+        lazy._lock = threading.Lock()
+    drop_inherited_driver()
+    if repository._instance is not None:
+        repository._instance.after_fork()
+
+os.register_at_fork(after_in_child=after_fork)
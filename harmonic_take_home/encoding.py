@@ -0,0 +1,100 @@
+import functools
+import gzip
+import json
+from flask import request, current_app, g
+
+#Content negotiation for the read routes. The body is json (with orjson if
+#it's installed) or MessagePack for clients that send
+#`Accept: application/msgpack`, and is compressed with zstd or gzip if the
+#client's Accept-Encoding allows it. msgpack, orjson and zstandard are all
+#optional; without them the json/gzip path is used
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MIMETYPES = {
+    'json': 'application/json',
+    'msgpack': 'application/msgpack'
+}
+
+def response_variant():
+    #(format, content encoding or None) for the current request
+    fmt = 'json'
+    if msgpack is not None:
+        best = request.accept_mimetypes.best_match(['application/json', 'application/msgpack', 'application/x-msgpack'])
+        if best in ('application/msgpack', 'application/x-msgpack'):
+            fmt = 'msgpack'
+    content_encoding = None
+    if zstandard is not None and request.accept_encodings['zstd']:
+        content_encoding = 'zstd'
+    elif request.accept_encodings['gzip']:
+        content_encoding = 'gzip'
+    return fmt, content_encoding
+
+def variant_name(variant):
+    fmt, content_encoding = variant
+    return f"{fmt}+{content_encoding}" if content_encoding else fmt
+
+def dumps(data, fmt):
+    if fmt == 'msgpack':
+        return msgpack.packb(data)
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
+def compress(body, content_encoding):
+    if content_encoding == 'zstd':
+        return zstandard.ZstdCompressor().compress(body)
+    if content_encoding == 'gzip':
+        return gzip.compress(body, compresslevel=5)
+    return body
+
+def build_response(body, variant):
+    fmt, content_encoding = variant
+    response = current_app.response_class(body, mimetype=MIMETYPES[fmt])
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.update(['Accept', 'Accept-Encoding'])
+    return response
+
+def encoded(data):
+    #Use instead of jsonify in the read routes. The data is kept on g for
+    #decorators (e.g. the cache's tags) that need it and can't parse msgpack
+    g.response_data = data
+    variant = response_variant()
+    return build_response(compress(dumps(data, variant[0]), variant[1]), variant)
+
+def conditional(get_version, unless=None):
+    #ETag from a data version that ingest bumps on every committed write.
+    #The version is read before the view runs, so the body is never older
+    #than its tag. A client that already has this version gets a 304 without
+    #the view (or Neo4j) being touched. Requests for which unless() is true
+    #depend on more than the data (e.g. the time) and get no ETag
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if unless is not None and unless():
+                return view(*args, **kwargs)
+            variant = response_variant()
+            etag = f"{get_version()}-{variant_name(variant)}"
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+                response.vary.update(['Accept', 'Accept-Encoding'])
+                return response
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,89 @@
+import json
+from harmonic_take_home import repository, metrics
+
+#Order the message types have to be written in -- e.g. an employment
+#edit only matches once the employment exists, and employments and
+#acquisitions need their companies
+WRITE_ORDER = [
+    "companies",
+    "person_employments",
+    "person_employments_edit",
+    "company_acquisitions"
+]
+
+#Called with (data_type, records) after records have been committed, e.g.
+#to invalidate cached reads. A failing listener can't undo the write, so
+#errors are only printed -- except for required listeners (the change log),
+#whose errors notify_applied raises. The caller then mustn't ack the
+#write's entries, so they're redelivered and re-applied (the writes are
+#idempotent), and the listeners get them again
+listeners = []
+required_listeners = []
+
+def add_listener(listener, required=False):
+    (required_listeners if required else listeners).append(listener)
+    return listener
+
+def notify_applied(data_type, records):
+    for listener in listeners:
+        try:
+            listener(data_type, records)
+        except Exception as e:
+            print(e)
+    #After the others, so cached reads are still invalidated if one raises
+    for listener in required_listeners:
+        listener(data_type, records)
+
+class MalformedMessage(ValueError):
+    #A message that can never be applied, however often it's retried
+    pass
+
+def message_records(restored_data):
+    #Every type sends a list, except edits, which can also send a single record
+    data = restored_data["data"]
+    return data if isinstance(data, list) else [data]
+
+def applied_records(records, unapplied):
+    #records without the ones apply_records returned
+    unapplied_ids = set(map(id, unapplied))
+    return [record for record in records if id(record) not in unapplied_ids]
+
+def parse_message(message):
+    #Returns (data_type, records) from a raw json message, or raises
+    #MalformedMessage if it isn't json, has no type/data or has an unknown type
+    try:
+        restored_data = json.loads(message)
+        data_type = restored_data['type']
+        records = message_records(restored_data)
+    except (ValueError, TypeError, KeyError) as e:
+        raise MalformedMessage(f"Can't read message: {e!r}") from e
+    if data_type not in WRITE_ORDER:
+        raise MalformedMessage(f"Unknown type passed to message handler: {data_type}")
+    if not all(isinstance(record, dict) for record in records):
+        raise MalformedMessage(f"{data_type} records have to be objects")
+    return data_type, records
+
+def apply_records(data_type, records):
+    #Callers are expected to wrap this in repository.transaction().
+    #Returns the records that couldn't be applied yet: edits of an employment
+    #that doesn't exist, e.g. because its hire went to another consumer and
+    #hasn't been written. Callers leave their messages un-acked, so they're
+    #retried later (and dead lettered if they never match)
+    match data_type:
+        case "companies":
+            repository.create_companies(records)
+        case "person_employments":
+            repository.create_employments(records)
+        case "person_employments_edit":
+            unmatched = repository.edit_employments(records)
+            if unmatched:
+                print(f"No employment found for {len(unmatched)} edits, retrying them later: {unmatched}")
+            return unmatched
+        case "company_acquisitions":
+            rejected = repository.create_acquisitions(records)
+            if rejected:
+                metrics.acquisitions_rejected.inc(len(rejected))
+                print(f"Rejected {len(rejected)} acquisitions that would make a cycle: {rejected}")
+        case _:
+            raise ValueError(f"Unknown type passed to message handler: {data_type}")
+    return []
@@ -0,0 +1,112 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+#Minimal in-process Prometheus metrics (counters and histograms), rendered
+#in the text exposition format by /metrics. Observing is a lock, a bisect
+#and two additions, cheap enough to leave on.
+#Note -- each process keeps its own numbers, so with several worker
+#processes every one of them has to be scraped
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+enabled = True
+registry = []
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # label values -> [per bucket counts (last one is +Inf), sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+query_seconds = Histogram('neo4j_query_seconds', 'Time spent in each Cypher query', ['query'])
+query_rows = Histogram('neo4j_query_rows', 'Rows returned by each Cypher query', ['query'], SIZE_BUCKETS)
+query_failures = Counter('neo4j_query_failures_total', 'Cypher queries that raised', ['query'])
+sqlite_query_seconds = Histogram('sqlite_query_seconds', 'Time spent in each SQLite query', ['query'])
+sqlite_query_rows = Histogram('sqlite_query_rows', 'Rows returned by each SQLite query', ['query'], SIZE_BUCKETS)
+sqlite_query_failures = Counter('sqlite_query_failures_total', 'SQLite queries that raised', ['query'])
+request_seconds = Histogram('http_request_seconds', 'Time spent serving each route', ['route', 'method', 'status'])
+ingest_messages = Counter('ingest_messages_total', 'Ingest messages received', ['type'])
+ingest_records = Histogram('ingest_batch_records', 'Records written per ingest transaction', ['type'], SIZE_BUCKETS)
+ingest_seconds = Histogram('ingest_apply_seconds', 'Time to apply and commit an ingest transaction', ['type'])
+ingest_failures = Counter('ingest_failures_total', 'Ingest transactions that failed', ['type'])
+ingest_notify_failures = Counter('ingest_notify_failures_total', 'Committed ingest writes left pending because a required listener failed', ['type'])
+ingest_consumer_restarts = Counter('ingest_consumer_restarts_total', 'Ingest consumer threads restarted after dying')
+acquisitions_rejected = Counter('ingest_acquisitions_rejected_total', 'Acquisitions not written because they would make a cycle')
+query_timeouts = Counter('query_timeouts_total', 'Reads stopped for running longer than QUERY_TIMEOUT', ['query'])
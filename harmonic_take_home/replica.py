@@ -0,0 +1,433 @@
+import functools
+import os
+import threading
+import time
+from array import array
+from collections import deque
+from harmonic_take_home.models import (EmploymentRow, employee_count_deltas, as_timestamp, CHAIN_MAX_DEPTH, CHAIN_MAX_RESULTS,
+                                       chain_params, bound_chains, acyclic_acquisitions, acquisition_company_ids)
+from harmonic_take_home.changes import ChangesExpired
+from harmonic_take_home.encoding import conditional
+
+#In-process copy of the company/acquisition/employment graph, so the
+#/company and /people reads can be answered without a Bolt round trip.
+#
+#ReplicaGraph holds the data: companies live in id-indexed arrays (a
+#company's slot is its position in every array), ACQUIRED edges are
+#adjacency lists of slots in both directions, and each company has its own
+#map of employments. It is loaded from a snapshot of the repository and then kept
+#current by applying the same (data_type, records) writes ingest commits.
+#
+#Replica keeps one loaded in the background: it notes the change feed's
+#seq, loads the snapshot, and then follows the feed from that seq. Writes
+#are all upserts, so changes the snapshot already contains are just applied
+#again. Reads are only served while the replica has caught up with the feed
+#within max_staleness seconds; otherwise callers go to the repository
+
+class ReplicaGraph:
+    def __init__(self):
+        self.slots = {} # company_id -> slot
+        self.company_ids = array('q')
+        self.company_names = []
+        self.headcounts = [] # Can be null in the data
+        self.current = array('q')
+        self.past = array('q')
+        self.family_current = array('q')
+        self.family_past = array('q')
+        self.parents = [] # slot -> parent slots
+        self.children = [] # slot -> acquired slots
+        self.employments = [] # slot -> {(person_id, start_date): (employment_title, end_date)}
+        self.edge_count = 0
+        self.employment_count = 0
+
+    @classmethod
+    def from_repository(cls, repository):
+        #Streams every company, acquisition and employment. The employee
+        #counts are recomputed from the employments that were read rather than
+        #copied, so they agree with them whatever was committed mid-snapshot
+        graph = cls()
+        for company in repository.stream_companies():
+            graph.put_company(company)
+        for parent_id, acquired_id in repository.stream_acquisitions():
+            graph.put_edge(parent_id, acquired_id)
+        for company_id, person_id, start_date, employment_title, end_date in repository.stream_employments():
+            slot = graph.slots.get(company_id)
+            if slot is not None:
+                existed, was_current = graph.put_employment(slot, (person_id, start_date), (employment_title, end_date))
+                graph.count(slot, existed, was_current, end_date is None)
+        graph.refresh_family(range(len(graph.company_ids)))
+        return graph
+
+    def put_company(self, company):
+        slot = self.slots.get(company['company_id'])
+        if slot is not None:
+            self.company_names[slot] = company['company_name']
+            self.headcounts[slot] = company['headcount']
+            return slot
+        slot = len(self.company_ids)
+        self.slots[company['company_id']] = slot
+        self.company_ids.append(company['company_id'])
+        self.company_names.append(company['company_name'])
+        self.headcounts.append(company['headcount'])
+        for counts in (self.current, self.past, self.family_current, self.family_past):
+            counts.append(0)
+        self.parents.append([])
+        self.children.append([])
+        self.employments.append({})
+        return slot
+
+    def put_edge(self, parent_id, acquired_id):
+        #Both companies have to exist, like the MATCHes in Acquisition.bulk_create
+        parent, acquired = self.slots.get(parent_id), self.slots.get(acquired_id)
+        if parent is None or acquired is None or acquired in self.children[parent]:
+            return None
+        self.children[parent].append(acquired)
+        self.parents[acquired].append(parent)
+        self.edge_count += 1
+        return parent
+
+    def put_employment(self, slot, key, value):
+        #Returns (existed, was_current) for the employee counts
+        previous = self.employments[slot].get(key)
+        self.employments[slot][key] = value
+        if previous is None:
+            self.employment_count += 1
+            return False, False
+        return True, previous[1] is None
+
+    def count(self, slot, existed, was_current, is_current):
+        #Own counts only, see employee_count_deltas
+        if existed:
+            (self.current if was_current else self.past)[slot] -= 1
+        (self.current if is_current else self.past)[slot] += 1
+
+    def walk(self, slot, edges):
+        #Breadth first, so slots come back ordered by depth like the
+        #ACQUIRED_TRANSITIVE queries. Each slot once, even across cycles
+        seen = {slot}
+        order = []
+        queue = deque(edges[slot])
+        while queue:
+            next_slot = queue.popleft()
+            if next_slot in seen:
+                continue
+            seen.add(next_slot)
+            order.append(next_slot)
+            queue.extend(edges[next_slot])
+        return order
+
+    def chain(self, slot, edges, max_depth, limit):
+        #(slot, depth) of the slots within max_depth of slot, nearest first
+        #and by company_id within a depth, like the chain sections' queries.
+        #Stops once `limit` have been found
+        seen = {slot}
+        level = [slot]
+        found = []
+        depth = 0
+        while level and depth < max_depth and len(found) < limit:
+            depth += 1
+            level = sorted(set(s for previous in level for s in edges[previous]) - seen,
+                           key=self.company_ids.__getitem__)
+            seen.update(level)
+            found.extend((s, depth) for s in level)
+        return found[:limit]
+
+    def reachable_pairs(self, company_ids):
+        #(ancestor, descendant) pairs among company_ids, like Acquisition.reachable_pairs
+        slots = {self.slots[company_id]: company_id for company_id in company_ids if company_id in self.slots}
+        return [(company_id, self.company_ids[descendant])
+                for slot, company_id in slots.items()
+                for descendant in self.walk(slot, self.children) if descendant in slots]
+
+    def refresh_family(self, slots):
+        #Same as Company.refresh_family_counts for exactly these slots
+        for slot in slots:
+            descendants = self.walk(slot, self.children)
+            self.family_current[slot] = self.current[slot] + sum(self.current[d] for d in descendants)
+            self.family_past[slot] = self.past[slot] + sum(self.past[d] for d in descendants)
+
+    def apply_count_deltas(self, changes):
+        #Same as Company.apply_employee_count_deltas
+        for delta in employee_count_deltas(changes):
+            slot = self.slots[delta['company_id']]
+            self.current[slot] += delta['current']
+            self.past[slot] += delta['past']
+            for member in [slot] + self.walk(slot, self.parents):
+                self.family_current[member] += delta['current']
+                self.family_past[member] += delta['past']
+
+    def create_employments(self, records):
+        #Records for unknown companies are dropped, like the MATCH in Employment.bulk_create
+        changes = []
+        for record in records:
+            slot = self.slots.get(record['company_id'])
+            if slot is None:
+                continue
+            end_date = as_timestamp(record.get('end_date'))
+            key = (record['person_id'], as_timestamp(record.get('start_date')))
+            existed, was_current = self.put_employment(slot, key, (record['employment_title'], end_date))
+            changes.append((record['company_id'], existed, was_current, end_date is None))
+        self.apply_count_deltas(changes)
+
+    def edit_employments(self, records):
+        #Only the employment_title/end_date that are set are changed, like Employment.bulk_edit
+        changes = []
+        for record in records:
+            slot = self.slots.get(record['company_id'])
+            start_date = as_timestamp(record['start_date']) if record.get('start_date') else None
+            key = (record['person_id'], start_date)
+            if slot is None or key not in self.employments[slot]:
+                continue
+            employment_title, end_date = self.employments[slot][key]
+            if record.get('employment_title'):
+                employment_title = record['employment_title']
+            if record.get('end_date'):
+                end_date = as_timestamp(record['end_date'])
+            _, was_current = self.put_employment(slot, key, (employment_title, end_date))
+            changes.append((record['company_id'], True, was_current, end_date is None))
+        self.apply_count_deltas(changes)
+
+    def apply(self, data_type, records):
+        #Mirrors ingest.apply_records
+        match data_type:
+            case "companies":
+                for record in records:
+                    self.put_company(record)
+            case "person_employments":
+                self.create_employments(records)
+            case "person_employments_edit":
+                self.edit_employments(records)
+            case "company_acquisitions":
+                #The same acquisitions are rejected as at ingest
+                records, _ = acyclic_acquisitions(records, self.reachable_pairs(acquisition_company_ids(records)))
+                parents = set()
+                for record in records:
+                    parents.add(self.put_edge(record['parent_company_id'], record['acquired_company_id']))
+                parents.discard(None)
+                family = set(parents)
+                for parent in parents:
+                    family.update(self.walk(parent, self.parents))
+                self.refresh_family(family)
+
+    def company_dict(self, slot):
+        #Same fields as Company.to_dict
+        return {
+            'company_id': self.company_ids[slot],
+            'company_name': self.company_names[slot],
+            'headcount': self.headcounts[slot],
+            'current_employee_count': self.current[slot],
+            'past_employee_count': self.past[slot],
+            'family_current_employee_count': self.family_current[slot],
+            'family_past_employee_count': self.family_past[slot]
+        }
+
+    def chain_dicts(self, slot, edges, max_depth, limit):
+        bounds = chain_params(max_depth, limit)
+        return [dict(self.company_dict(s), depth=depth)
+                for s, depth in self.chain(slot, edges, bounds['max_depth'], bounds['chain_limit'])]
+
+    def company_data(self, company_ids, sections=(), max_depth=CHAIN_MAX_DEPTH, limit=CHAIN_MAX_RESULTS):
+        #Same payload as Company.get_company_data
+        company_data = []
+        for company_id in company_ids:
+            slot = self.slots.get(company_id)
+            if slot is None:
+                continue
+            data = {'company': self.company_dict(slot)}
+            for section in sections:
+                match section:
+                    case 'parent':
+                        parents = self.parents[slot]
+                        data['parent'] = self.company_dict(parents[0]) if parents else None
+                    case 'ancestors':
+                        data['ancestors'] = self.chain_dicts(slot, self.parents, max_depth, limit)
+                    case 'acquisitions':
+                        data['acquisitions'] = [self.company_dict(s) for s in self.children[slot]]
+                    case 'descendants':
+                        data['descendants'] = self.chain_dicts(slot, self.children, max_depth, limit)
+            company_data.append(bound_chains(data, max_depth, limit))
+        return company_data
+
+    def family_slots(self, company_ids, include_descendants=False, include_ancestors=False):
+        #Same companies as models.family_ids_clause, each once
+        slots = {}
+        for company_id in company_ids:
+            slot = self.slots.get(company_id)
+            if slot is None:
+                continue
+            slots[slot] = None
+            if include_descendants:
+                slots.update(dict.fromkeys(self.walk(slot, self.children)))
+            if include_ancestors:
+                slots.update(dict.fromkeys(self.walk(slot, self.parents)))
+        return list(slots)
+
+    def employment_rows(self, company_ids, past=False, present=False,
+                        include_descendants=False, include_ancestors=False, period=None):
+        #Same rows as Person.get_employment_rows_in_companies
+        rows = []
+        for slot in self.family_slots(company_ids, include_descendants, include_ancestors):
+            company_name = self.company_names[slot]
+            for (person_id, start_date), (employment_title, end_date) in self.employments[slot].items():
+                if past and not present and end_date is None:
+                    continue
+                if present and not past and end_date is not None:
+                    continue
+                if period is not None:
+                    period_start, period_end = period
+                    if start_date is None or start_date > period_end:
+                        continue
+                    if end_date is not None and period_start is not None and end_date < period_start:
+                        continue
+                rows.append(EmploymentRow(person_id, company_name, employment_title))
+        return rows
+
+class ReplicaUnavailable(Exception):
+    pass
+
+class Replica:
+    def __init__(self, repository, change_log, enabled=True, max_staleness=5, block_ms=1000, retry_interval=5,
+                 reload_interval=3600):
+        self.repository = repository
+        self.change_log = change_log
+        self.enabled = enabled
+        self.max_staleness = max_staleness
+        self.block_ms = block_ms
+        self.retry_interval = retry_interval
+        self.reload_interval = reload_interval
+        self.graph = None
+        self.seq = 0
+        self.synced_at = None # Last time the replica had applied everything in the feed
+        self.loaded_at = None
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def start(self):
+        #Started lazily by the first read in each process, since the thread
+        #(and the lock, if it was held) don't survive a fork. A graph loaded
+        #before the fork (see harmonic_take_home.warm_up) is kept, and
+        #followed on from its seq, instead of every worker loading its own
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.synced_at = None
+        threading.Thread(target=self.run, name='replica', daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                if self.graph is None or self.reload_due():
+                    self.load()
+                self.follow()
+            except ChangesExpired:
+                print("Replica fell behind the change feed, reloading")
+                self.drop()
+            except Exception as e:
+                #Reads go to the repository until the replica is back
+                print(f"Replica stopped: {e}")
+                self.drop()
+                time.sleep(self.retry_interval)
+
+    def drop(self):
+        with self.lock:
+            self.graph, self.synced_at = None, None
+
+    def reload_due(self):
+        #A write whose change log append failed is re-applied and appended
+        #when it's redelivered, but a write that's never redelivered (or
+        #was changed in the db by hand) is only picked up by a fresh load.
+        #The old graph keeps serving while the new one loads
+        return bool(self.reload_interval) and time.time() - self.loaded_at > self.reload_interval
+
+    def load(self):
+        seq = self.change_log.latest()
+        graph = ReplicaGraph.from_repository(self.repository)
+        with self.lock:
+            self.graph, self.seq, self.synced_at = graph, seq, None
+            self.loaded_at = time.time()
+
+    def follow(self, limit=1000):
+        for entries in self.change_log.follow(self.seq, block_ms=self.block_ms, limit=limit):
+            if entries:
+                with self.lock:
+                    for entry in entries:
+                        self.graph.apply(entry['type'], entry['data'])
+                    self.seq = entries[-1]['seq']
+            if len(entries) < limit:
+                self.synced_at = time.time()
+                if self.reload_due():
+                    return
+
+    def age(self):
+        #Seconds since the replica was last known to have every change.
+        #Changes committed in that window may not be visible yet
+        return time.time() - self.synced_at if self.synced_at is not None else None
+
+    def current_age(self):
+        #age() if the replica is current enough to serve reads, None otherwise.
+        #synced_at can be reset by the replica thread at any time, so callers
+        #should use the age this returns rather than asking again
+        if not self.enabled:
+            return None
+        self.start()
+        age = self.age()
+        return age if age is not None and age <= self.max_staleness else None
+
+    def is_current(self):
+        return self.current_age() is not None
+
+    def version(self):
+        #For ETags, the seq of the last change applied
+        return self.seq
+
+    def current_graph(self):
+        #Call with the lock held. The graph can be dropped between
+        #current_age() and the read
+        if self.graph is None:
+            raise ReplicaUnavailable("Replica isn't loaded")
+        return self.graph
+
+    def company_data(self, company_ids, sections=(), **bounds):
+        with self.lock:
+            return self.current_graph().company_data(company_ids, sections, **bounds)
+
+    def employment_rows(self, company_ids, **kwargs):
+        with self.lock:
+            return self.current_graph().employment_rows(company_ids, **kwargs)
+
+    def status(self):
+        graph = self.graph
+        return {
+            'enabled': self.enabled,
+            'current': self.is_current(),
+            'seq': self.seq,
+            'age': self.age(),
+            'max_staleness': self.max_staleness,
+            'companies': len(graph.company_ids) if graph else None,
+            'acquisitions': graph.edge_count if graph else None,
+            'employments': graph.employment_count if graph else None
+        }
+
+def replicated(replica, read, serves=None, unless=None):
+    #Answers a view's requests with `read` instead while the replica is
+    #current, and with the view itself otherwise. serves(*args, **kwargs)
+    #can turn down requests the replica can't answer. Replica responses are
+    #tagged with the replica's seq (unless `unless`, as for conditional), and
+    #say how stale they can be
+    def decorator(view):
+        conditional_read = conditional(replica.version, unless)(read)
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            age = replica.current_age()
+            if age is None or (serves is not None and not serves(*args, **kwargs)):
+                return view(*args, **kwargs)
+            try:
+                response = conditional_read(*args, **kwargs)
+            except ReplicaUnavailable:
+                return view(*args, **kwargs)
+            response.headers['X-Replica-Seq'] = str(replica.seq)
+            response.headers['X-Replica-Age'] = f"{age:.3f}"
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,184 @@
+from abc import ABC, abstractmethod
+from harmonic_take_home.models import (Company, Person, Employment, Acquisition, install_schema, transaction,
+                                       CHAIN_MAX_DEPTH, CHAIN_MAX_RESULTS)
+from harmonic_take_home.search import lucene_query, candidate_limit, rank_companies
+
+#Everything the app stores or reads goes through a repository, so the
+#storage backend can be swapped by config (STORAGE_BACKEND):
+# - 'neo4j', the neomodel/Cypher methods on the models in models.py
+# - 'sqlite', an embedded SQLite file, see sqlite_repository.py
+#
+#Both take and return the same shapes (the ingest records, the /company
+#payload dicts, EmploymentRow), so routes, ingest and the replica don't
+#know which one they're using.
+
+class Repository(ABC):
+    name = None
+
+    @abstractmethod
+    def transaction(self):
+        #Context manager, everything written inside it commits together
+        raise NotImplementedError
+
+    @abstractmethod
+    def after_fork(self):
+        #Called in a forked child, see connections.after_fork. Drops the
+        #connections inherited from the parent without closing them
+        raise NotImplementedError
+
+    @abstractmethod
+    def install_schema(self):
+        raise NotImplementedError
+
+    #Ingest, one method per message type
+    @abstractmethod
+    def create_companies(self, companies_data):
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_employments(self, person_employments_data):
+        #Creates the people too
+        raise NotImplementedError
+
+    @abstractmethod
+    def edit_employments(self, person_employments_data):
+        #Returns the records that didn't match an employment
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_acquisitions(self, company_acquisitions_data):
+        #Returns the records that weren't written because they'd make a
+        #cycle, see models.acyclic_acquisitions
+        raise NotImplementedError
+
+    #Recovery
+    @abstractmethod
+    def rebuild_acquisitions(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def rebuild_employee_counts(self):
+        raise NotImplementedError
+
+    #Reads
+    @abstractmethod
+    def get_company_data(self, company_ids, sections=(), max_depth=CHAIN_MAX_DEPTH, limit=CHAIN_MAX_RESULTS):
+        #ancestors/descendants are bounded by max_depth and limit, see models.bound_chains
+        raise NotImplementedError
+
+    @abstractmethod
+    def company_page(self, after=None, limit=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def people_page(self, after=None, limit=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream_companies(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream_people(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def acquisition_chain_ids(self, company_ids):
+        raise NotImplementedError
+
+    @abstractmethod
+    def search_companies(self, query, limit=10):
+        #[{'company': {...}, 'score': ...}] by name, see search.py
+        raise NotImplementedError
+
+    @abstractmethod
+    def employment_rows(self, company_ids, past=False, present=False,
+                        include_descendants=False, include_ancestors=False, period=None):
+        raise NotImplementedError
+
+    #Snapshots, for the replica
+    @abstractmethod
+    def stream_acquisitions(self):
+        #(parent_company_id, acquired_company_id) pairs
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream_employments(self):
+        #(company_id, person_id, start_date, employment_title, end_date) tuples
+        raise NotImplementedError
+
+class Neo4jRepository(Repository):
+    name = 'neo4j'
+
+    def transaction(self):
+        return transaction()
+
+    def after_fork(self):
+        #neomodel's driver is dropped by connections.after_fork, whichever
+        #backend is configured
+        pass
+
+    def install_schema(self):
+        install_schema()
+
+    def create_companies(self, companies_data):
+        Company.bulk_create(companies_data)
+
+    def create_employments(self, person_employments_data):
+        Person.bulk_create(person_employments_data)
+        Employment.bulk_create(person_employments_data)
+
+    def edit_employments(self, person_employments_data):
+        return Employment.bulk_edit(person_employments_data)
+
+    def create_acquisitions(self, company_acquisitions_data):
+        return Acquisition.bulk_create(company_acquisitions_data)
+
+    def rebuild_acquisitions(self):
+        Acquisition.rebuild_closure()
+
+    def rebuild_employee_counts(self):
+        Company.rebuild_employee_counts()
+
+    def get_company_data(self, company_ids, sections=(), max_depth=CHAIN_MAX_DEPTH, limit=CHAIN_MAX_RESULTS):
+        return Company.get_company_data(company_ids, sections, max_depth, limit)
+
+    def company_page(self, after=None, limit=None):
+        return Company.get_page(after, limit)
+
+    def people_page(self, after=None, limit=None):
+        return Person.get_page(after, limit)
+
+    def stream_companies(self):
+        return Company.stream_all()
+
+    def stream_people(self):
+        return Person.stream_all()
+
+    def acquisition_chain_ids(self, company_ids):
+        return Company.get_acquisition_chain_ids(company_ids)
+
+    def search_companies(self, query, limit=10):
+        candidates = Company.search_names(lucene_query(query), candidate_limit(limit))
+        return rank_companies(query, candidates, limit)
+
+    def employment_rows(self, company_ids, past=False, present=False,
+                        include_descendants=False, include_ancestors=False, period=None):
+        return Person.get_employment_rows_in_companies(
+            company_ids, past, present, include_descendants, include_ancestors, period)
+
+    def stream_acquisitions(self):
+        return Acquisition.stream_edges()
+
+    def stream_employments(self):
+        return Employment.stream_all()
+
+def create_repository(app_config):
+    match app_config['STORAGE_BACKEND']:
+        case 'neo4j':
+            return Neo4jRepository()
+        case 'sqlite':
+            from harmonic_take_home.sqlite_repository import SQLiteRepository
+            return SQLiteRepository(app_config['SQLITE_PATH'], query_timeout=app_config['QUERY_TIMEOUT'])
+        case backend:
+            raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
@@ -1,102 +1,311 @@
-from flask import Flask, Response, jsonify, request
+from flask import Blueprint, Response, jsonify, request, abort, g, current_app
 import json
+import time
 from neomodel import UniqueProperty
-from harmonic_take_home import app, redis_conn
-from harmonic_take_home.models import Company, Person, Employment, Acquisition
+from harmonic_take_home import redis_conn, repository
+from harmonic_take_home.models import COMPANY_SECTIONS, QueryTimedOut, employment_period
+from harmonic_take_home.ingest import parse_message, apply_records, applied_records, notify_applied, add_listener
+from harmonic_take_home.worker import ingest_health
+from harmonic_take_home.changes import ChangeLog, ChangesExpired
+from harmonic_take_home.encoding import encoded, conditional
+from harmonic_take_home import metrics
+from harmonic_take_home.cache import ResponseCache, cached, company_tags, people_tags
+from harmonic_take_home.replica import Replica, replicated
 
-#Note, this is to start connection to the redis stream
-@app.route('/stream')
+api = Blueprint('api', __name__)
+
+#Made here so the views below can be decorated with them, and given their
+#settings by the app the blueprint is registered on. None of them connects
+#to Redis or the db until it's used
+response_cache = ResponseCache(redis_conn)
+add_listener(response_cache.invalidate_for_write)
+change_log = ChangeLog(redis_conn)
+#Required, so a write isn't acked until it has a seq in the change log
+add_listener(change_log.record_applied, required=True)
+replica = Replica(repository, change_log)
+
+@api.record
+def configure(state):
+    config = state.app.config
+    response_cache.ttl = config['CACHE_TTL']
+    response_cache.max_entries = config['CACHE_MAX_ENTRIES']
+    change_log.stream_name = config['CHANGES_STREAM']
+    change_log.max_len = config['CHANGES_MAX_LEN']
+    replica.enabled = config['REPLICA_ENABLED']
+    replica.max_staleness = config['REPLICA_MAX_STALENESS']
+    replica.block_ms = config['REPLICA_BLOCK_MS']
+    replica.reload_interval = config['REPLICA_RELOAD_INTERVAL']
+
+@api.before_app_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@api.after_app_request
+def record_request(response):
+    #Labelled by the route pattern rather than the path, so /company/<company_id>
+    #is one series. Streamed responses are timed up to the first byte
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.request_seconds.observe(time.perf_counter() - start,
+            route=route, method=request.method, status=response.status_code)
+    return response
+
+#Reads that ran past QUERY_TIMEOUT, e.g. a traversal over a huge family
+@api.app_errorhandler(QueryTimedOut)
+def query_timed_out(error):
+    return jsonify({'error': str(error)}), 503
+
+@api.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+#Ingest runs in its own process (`flask ingest-worker`), this reports
+#whether its consumers are heartbeating and how far behind the stream they are
+@api.route('/ingest/health')
+def ingest_health_endpoint():
+    health = ingest_health(redis_conn, current_app.config['STREAM_NAME'], current_app.config['STREAM_GROUP'],
+                           current_app.config['INGEST_STALE_AFTER'])
+    return jsonify(health), 200 if health['healthy'] else 503
+
+#What the in-process replica has loaded and how far behind it may be
+@api.route('/replica/status')
+def replica_status():
+    return jsonify(replica.status())
+
+#Changes committed after `since` (a seq, 0 for the beginning), oldest first.
+#Clients keep the returned next_since as their cursor; a 410 means their
+#cursor is older than the kept log and they need a full snapshot first
+@api.route('/changes')
+def changes():
+    since = request.args.get('since', 0, type=int)
+    limit = requested_bound(request.args, 'limit', current_app.config['CHANGES_PAGE_LIMIT'])
+    try:
+        entries = change_log.since(since, limit)
+    except ChangesExpired as e:
+        return jsonify({'error': str(e), 'oldest': e.oldest, 'latest': change_log.latest()}), 410
+    return jsonify({
+        'changes': entries,
+        'next_since': entries[-1]['seq'] if entries else since,
+        'latest': change_log.latest()
+    })
+
+def sse_events(since, block_ms):
+    #The SSE id is the seq, so a reconnecting EventSource resumes from
+    #Last-Event-ID by itself. Comments keep idle connections open
+    try:
+        for entries in change_log.follow(since, block_ms=block_ms):
+            if not entries:
+                yield ": keepalive\n\n"
+            for entry in entries:
+                yield f"id: {entry['seq']}\nevent: change\ndata: {json.dumps(entry)}\n\n"
+    except ChangesExpired as e:
+        yield f"event: expired\ndata: {json.dumps({'error': str(e), 'oldest': e.oldest})}\n\n"
+
+#Server-sent events version of /changes. Each open stream holds a web worker
+#thread, so run the app threaded when clients use it
+@api.route('/stream')
 def stream():
-    print("STARTING STREAM")
-    return Response(redis_subscriber(), mimetype="text/event-stream")
+    since = request.headers.get('Last-Event-ID', None, type=int)
+    if since is None:
+        since = request.args.get('since', change_log.latest(), type=int)
+    events = sse_events(since, current_app.config['CHANGES_SSE_BLOCK_MS'])
+    return Response(events, mimetype="text/event-stream", headers={'Cache-Control': 'no-cache'})
+
+def json_array_chunks(rows, chunk_rows=500):
+    #Streams a json array, a few hundred rows per chunk rather than one
+    #write per row
+    yield '['
+    chunk = []
+    separator = ''
+    for row in rows:
+        chunk.append(json.dumps(row))
+        if len(chunk) >= chunk_rows:
+            yield separator + ','.join(chunk)
+            separator = ','
+            chunk = []
+    if chunk:
+        yield separator + ','.join(chunk)
+    yield ']'
+
+def ndjson_chunks(rows, chunk_rows=500):
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(row) + '\n')
+        if len(chunk) >= chunk_rows:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
 
-@app.route('/companies')
+def list_response(get_page, stream_all, key):
+    #Full listings of Company/Person nodes. Either
+    # - stream=json / stream=ndjson, streamed straight off the driver, or
+    # - limit/after, a keyset page of {data: [...], next_after: <key or null>}
+    #   where next_after is passed as `after` to get the next page, or
+    # - neither, the whole list
+    stream = request.args.get('stream')
+    if stream == 'ndjson':
+        return Response(ndjson_chunks(stream_all()), mimetype='application/x-ndjson')
+    if stream == 'json':
+        return Response(json_array_chunks(stream_all()), mimetype='application/json')
+    if stream is not None:
+        abort(400, "stream must be json or ndjson")
+
+    after = requested_int(request.args, 'after')
+    if after is None and 'limit' not in request.args:
+        return encoded(get_page())
+    limit = requested_bound(request.args, 'limit', current_app.config['PAGE_MAX_LIMIT'], current_app.config['PAGE_DEFAULT_LIMIT'])
+    rows = get_page(after, limit)
+    next_after = rows[-1][key] if len(rows) == limit else None
+    return encoded({'data': rows, 'next_after': next_after})
+
+@api.route('/companies')
+@conditional(change_log.latest)
 def companies():
-    companies = Company.nodes.all()
-    company_data = [company.to_dict() for company in companies]
-    return jsonify(company_data)
+    return list_response(repository.company_page, repository.stream_companies, 'company_id')
+
+# Companies by name, best match first, for type-ahead. Matches whole names,
+# prefixes of the name or of any word in it, and typos, e.g. ?q=aimco%20apa
+@api.route('/companies/search')
+@conditional(change_log.latest)
+def companies_search():
+    query = request.args.get('q', '')
+    if not query.strip():
+        abort(400, "q is required")
+    limit = requested_bound(request.args, 'limit', current_app.config['SEARCH_MAX_LIMIT'], current_app.config['SEARCH_DEFAULT_LIMIT'])
+    return encoded(repository.search_companies(query, limit))
+
+def requested_sections(args):
+    return [section for section in COMPANY_SECTIONS if args.get(section, False)]
 
-@app.route('/company/<company_id>')
+def requested_int(args, name, default=None):
+    #An integer parameter, `default` if it's missing, a 400 if it isn't an integer
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        abort(400, f"{name} must be an integer")
+
+def requested_bound(args, name, cap, default=None):
+    #An integer parameter clamped to 1..cap, `default` (or cap) if it's missing
+    return max(1, min(requested_int(args, name, cap if default is None else default), cap))
+
+def requested_chain_bounds(args):
+    #How far ancestors/descendants go and how many come back, within the server's budget
+    return {
+        'max_depth': requested_bound(args, 'max_depth', current_app.config['TRAVERSAL_MAX_DEPTH']),
+        'limit': requested_bound(args, 'limit', current_app.config['TRAVERSAL_MAX_RESULTS'])
+    }
+
+def requested_company_ids(company_ids):
+    try:
+        return [int(company_id) for company_id in company_ids]
+    except (TypeError, ValueError):
+        abort(400, "company ids must be integers")
+
+def company_from_replica(company_id):
+    company_data = replica.company_data(requested_company_ids([company_id]), requested_sections(request.args),
+                                        **requested_chain_bounds(request.args))
+    if not company_data:
+        abort(404)
+    return encoded(company_data[0])
+
+@api.route('/company/<company_id>')
+@replicated(replica, company_from_replica)
+@conditional(change_log.latest)
+@cached(response_cache, company_tags)
 def company(company_id):
-    # NOTE - we run up to 5 queries in this API call
-    # It would be better to push these all into one query
-    # But I am running out of time
-    company = Company.nodes.get(company_id=int(company_id))
-    company_data = {'company': company.to_dict() }
-
-    if request.args.get('parent', False):
-        parent = company.get_parent_company()
-        company_data['parent'] = parent and parent.to_dict()
-    if request.args.get('ancestors', False):
-        ancestors = company.get_all_ancestor_companies()
-        company_data['ancestors'] = [ancestor.to_dict() for ancestor in ancestors]
-    if request.args.get('acquisitions', False):
-        acquisitions = company.get_acquired_companies()
-        company_data['acquisitions'] = [acquisition.to_dict() for acquisition in acquisitions]
-    if request.args.get('descendants', False):
-        descendants = company.get_all_descendant_companies()
-        company_data['descendants'] = [descendant.to_dict() for descendant in descendants]
-
-    return jsonify(company_data)
-
-@app.route('/people')
+    # Everything the flags ask for comes back from a single query
+    company_data = repository.get_company_data(requested_company_ids([company_id]), requested_sections(request.args),
+                                               **requested_chain_bounds(request.args))
+    if not company_data:
+        abort(404)
+    return encoded(company_data[0])
+
+# Same payload as /company/<company_id>, for a list of ids in one query.
+# Body is e.g. {"company_ids": [2001628, 3205143], "parent": true, "descendants": true}
+@api.route('/companies/lookup', methods=['POST'])
+def companies_lookup():
+    body = request.get_json(silent=True) or {}
+    company_ids = body.get('company_ids')
+    if not isinstance(company_ids, list):
+        abort(400, "company_ids must be a list")
+    if len(company_ids) > current_app.config['LOOKUP_MAX_IDS']:
+        abort(400, f"At most {current_app.config['LOOKUP_MAX_IDS']} company_ids per lookup")
+    company_ids = requested_company_ids(company_ids)
+    return encoded(repository.get_company_data(company_ids, requested_sections(body), **requested_chain_bounds(body)))
+
+def requested_period(args):
+    try:
+        return employment_period(args.get('as_of'), args.get('from'), args.get('to'))
+    except ValueError as e:
+        abort(400, str(e))
+
+def requested_employment_filters(args):
+    return {
+        'past': args.get('past', False),
+        'present': args.get('present', False),
+        'include_descendants': args.get('include_descendants', False),
+        'include_ancestors': args.get('include_ancestors', False),
+        'period': requested_period(args)
+    }
+
+def time_relative():
+    #`from` without `to` runs up to now, so the same request matches more
+    #employments as time passes without any write bumping the version
+    return bool(request.args.get('from')) and not request.args.get('to') and not request.args.get('as_of')
+
+def people_from_replica():
+    company_ids = json.loads(request.args['company_ids'])
+    rows = replica.employment_rows(company_ids, **requested_employment_filters(request.args))
+    return encoded([row.to_dict() for row in rows])
+
+def has_company_ids():
+    #The full people listing always comes from Neo4j
+    return bool(request.args.get('company_ids', False))
+
+@api.route('/people')
+@replicated(replica, people_from_replica, serves=has_company_ids, unless=time_relative)
+@conditional(change_log.latest, unless=time_relative)
+@cached(response_cache, people_tags, unless=time_relative)
 def people():
-    if request.args.get('company_ids', False):
-        company_ids = json.loads(request.args.get('company_ids', False))
-        if request.args.get('past', False):
-            if request.args.get('present', False):
-                people = Person.get_employees_in_companies(company_ids)
-            else:
-                people = Person.get_past_employees_in_companies(company_ids)
-        elif request.args.get('present', False):
-            people = Person.get_current_employees_in_companies(company_ids)
-        else:
-            people = Person.get_employees_in_companies(company_ids)
-        people_data = [{'person_id': person['person'].person_id, 'company_name': person['company_name'], 'employment_title': person['employment_title']} for person in people]
-    else:
-        people = Person.nodes.all()
-        people_data = [{'person_id': person.person_id} for person in people]
-    return jsonify(people_data)
-
-@app.route('/')
-def index():
-    return "Flask app running with Redis Pub/Sub."
+    if not request.args.get('company_ids', False):
+        return list_response(repository.people_page, repository.stream_people, 'person_id')
 
-def redis_subscriber():
-    pubsub = redis_conn.pubsub()
-    pubsub.subscribe('flask_channel')
+    company_ids = json.loads(request.args.get('company_ids', False))
+    rows = repository.employment_rows(company_ids, **requested_employment_filters(request.args))
+    return encoded([row.to_dict() for row in rows])
 
-    for message in pubsub.listen():
-        if message['type'] == 'message':
-            message_handler(message['data'])
+@api.route('/')
+def index():
+    return "Flask app running with Redis Pub/Sub."
 
+#Returns True once the write has been committed, so the stream consumer
+#knows the entry can be acked. Failed writes stay pending and get retried.
+#The stream consumer batches through BatchWriter instead; this applies a
+#single message in its own transaction. Raises MalformedMessage for messages
+#that can't be applied, which the consumer dead letters
 def message_handler(message):
-    restored_data = json.loads(message)
-    data_type = restored_data['type']
-
-    match data_type:
-        case "companies":
-            try:
-                Company.bulk_create(restored_data["data"])
-            except Exception as e:
-                print(e)
-        case "person_employments":
-            try:
-                Person.bulk_create(restored_data["data"])
-                Employment.bulk_create(restored_data["data"])
-            except Exception as e:
-                print(e)
-        case "person_employments_edit":
-            try:
-                Employment.edit(restored_data["data"])
-            except Exception as e:
-                print(e)
-        case "company_acquisitions":
-            try:
-                Acquisition.bulk_create(restored_data["data"])
-            except Exception as e:
-                print(e)
-        case _:
-            print("Unknown type passed to message handler")
-    
-
+    data_type, records = parse_message(message)
+    metrics.ingest_messages.inc(type=data_type)
+    start = time.perf_counter()
+    try:
+        with repository.transaction():
+            unapplied = apply_records(data_type, records)
+    except Exception as e:
+        print(e)
+        metrics.ingest_failures.inc(type=data_type)
+        return False
+    metrics.ingest_seconds.observe(time.perf_counter() - start, type=data_type)
+    metrics.ingest_records.observe(len(records), type=data_type)
+    try:
+        notify_applied(data_type, applied_records(records, unapplied))
+    except Exception as e:
+        print(f"Leaving {data_type} write pending, notifying it failed: {e}")
+        metrics.ingest_notify_failures.inc(type=data_type)
+        return False
+    #Edits that didn't match yet are retried with the rest of the message
+    return not unapplied
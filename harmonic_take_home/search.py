@@ -0,0 +1,96 @@
+import re
+
+#Company name search for /companies/search, shared by the backends.
+#
+#Each backend first pulls candidates from its own name index (a Neo4j
+#full-text index, a SQLite FTS5 trigram table), which is maintained by the
+#db as companies are written. The candidates are then ranked here the same
+#way on both:
+# - the whole name, then a prefix of the name, then a prefix of a later
+#   word, then anywhere in the name
+# - then typos: the start of the name or of a word within a few edits of
+#   the query, scored by how many
+#Ties go to the shorter name, so "Acme" comes before "Acme Holdings"
+
+#How many candidates the index is asked for per result returned
+CANDIDATES_PER_RESULT = 10
+MIN_CANDIDATES = 50
+#Least similarity (1 - edits / query length) a typo match can have
+MIN_SIMILARITY = 0.6
+#Most names sharing any trigram with the query that are read looking for
+#typos, when too few names contain the query itself
+MAX_TYPO_CANDIDATES = 2000
+
+LUCENE_SPECIAL = re.compile(r'([+\-&|!(){}\[\]^"~*?:\\/])')
+
+def normalize(text):
+    return ' '.join(text.lower().split())
+
+def candidate_limit(limit):
+    return max(limit * CANDIDATES_PER_RESULT, MIN_CANDIDATES)
+
+def lucene_query(query):
+    #Every word has to match, exactly, as a prefix, or (if it's long enough
+    #to tell) within one or two edits
+    clauses = []
+    for word in normalize(query).split():
+        word = LUCENE_SPECIAL.sub(r'\\\1', word)
+        options = [f"{word}^2", f"{word}*"]
+        if len(word) >= 5:
+            options.append(f"{word}~2")
+        elif len(word) >= 3:
+            options.append(f"{word}~1")
+        clauses.append(f"+({' OR '.join(options)})")
+    return ' '.join(clauses)
+
+def trigrams(text):
+    return [text[i:i + 3] for i in range(len(text) - 2)]
+
+def fts5_query(query, require_all=True):
+    #All of the query's trigrams (names containing the query, give or take
+    #the order), or any of them for typos, quoted so FTS5 doesn't parse
+    #them. Queries shorter than a trigram can't use the index, see like_prefix
+    grams = dict.fromkeys(trigrams(normalize(query)))
+    operator = ' AND ' if require_all else ' OR '
+    return operator.join('"' + gram.replace('"', '""') + '"' for gram in grams)
+
+def like_prefix(query):
+    #LIKE pattern for names starting with the query, escaped with \
+    return re.sub(r'([\\%_])', r'\\\1', normalize(query)) + '%'
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+def match_score(query, name):
+    #1 for the exact name down to MIN_SIMILARITY * 0.6 for the worst typo, 0 for no match
+    name = normalize(name)
+    if name == query:
+        return 1.0
+    if name.startswith(query):
+        return 0.9
+    word_starts = [0] + [i + 1 for i, char in enumerate(name) if char == ' ']
+    if any(name.startswith(query, start) for start in word_starts[1:]):
+        return 0.8
+    if query in name:
+        return 0.7
+    best = 0
+    for start in word_starts:
+        for length in (len(query) - 1, len(query), len(query) + 1):
+            window = name[start:start + length]
+            if window:
+                best = max(best, 1 - edit_distance(query, window) / len(query))
+    return 0.6 * best if best >= MIN_SIMILARITY else 0
+
+def rank_companies(query, companies, limit):
+    #[{'company': company, 'score': score}], best first
+    query = normalize(query)
+    scored = [(match_score(query, company['company_name']), company) for company in companies]
+    scored = [(score, company) for score, company in scored if score > 0]
+    scored.sort(key=lambda match: (-match[0], len(match[1]['company_name']), match[1]['company_name']))
+    return [{'company': company, 'score': round(score, 3)} for score, company in scored[:limit]]
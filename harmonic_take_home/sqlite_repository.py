@@ -0,0 +1,509 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from harmonic_take_home import metrics
+from harmonic_take_home.models import (EmploymentRow, employee_count_deltas, employment_end_filter, keyset_page_query, as_timestamp,
+                                       QueryTimedOut, CHAIN_SECTIONS, CHAIN_MAX_DEPTH, CHAIN_MAX_RESULTS, chain_params, bound_chains,
+                                       acyclic_acquisitions, acquisition_company_ids)
+from harmonic_take_home.repository import Repository
+from harmonic_take_home.search import fts5_query, like_prefix, candidate_limit, rank_companies, MAX_TYPO_CANDIDATES
+
+#Repository on an embedded SQLite file, for running without Neo4j.
+#
+#Acquisitions are a plain (parent, acquired) table. Ancestors and
+#descendants are recursive CTEs over it rather than a stored closure, so
+#a whole chain is still one query, and an acquisition is a single insert.
+#The employments index covers the /people reads: a seek on company_id
+#(and start_date for as_of/from/to) answers them without touching the table.
+#Ingest writes each batch with executemany, and keeps the same employee
+#counters as the Neo4j backend.
+#
+#Company names are indexed for /companies/search in an FTS5 trigram table,
+#kept in sync with companies by triggers.
+#
+#Each thread gets its own connection. The file is in WAL mode, so reads
+#don't wait on the writer. Reads outside a transaction are interrupted
+#after query_timeout seconds, like the Neo4j read timeout
+
+#Recursive CTEs stop at this depth. Ingest rejects cycles, this is only
+#there so one written before that can't loop forever
+MAX_CHAIN_DEPTH = 100
+
+#How many SQLite VM instructions run between checks of the read deadline
+TIMEOUT_CHECK_INSTRUCTIONS = 10000
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS companies (
+        company_id INTEGER PRIMARY KEY,
+        company_name TEXT NOT NULL UNIQUE,
+        headcount INTEGER,
+        current_employee_count INTEGER NOT NULL DEFAULT 0,
+        past_employee_count INTEGER NOT NULL DEFAULT 0,
+        family_current_employee_count INTEGER NOT NULL DEFAULT 0,
+        family_past_employee_count INTEGER NOT NULL DEFAULT 0
+    )""",
+    "CREATE TABLE IF NOT EXISTS people (person_id INTEGER PRIMARY KEY)",
+    """
+    CREATE TABLE IF NOT EXISTS employments (
+        person_id INTEGER NOT NULL,
+        company_id INTEGER NOT NULL,
+        start_date INTEGER,
+        end_date INTEGER,
+        employment_title TEXT NOT NULL
+    )""",
+    #An employment is identified by (person, company, start_date), like in Neo4j
+    "CREATE UNIQUE INDEX IF NOT EXISTS employments_key ON employments (person_id, company_id, start_date)",
+    "CREATE INDEX IF NOT EXISTS employments_by_company ON employments (company_id, start_date, end_date, person_id, employment_title)",
+    """
+    CREATE TABLE IF NOT EXISTS acquisitions (
+        parent_company_id INTEGER NOT NULL,
+        acquired_company_id INTEGER NOT NULL,
+        merged_into_parent_company INTEGER,
+        PRIMARY KEY (parent_company_id, acquired_company_id)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS acquisitions_by_acquired ON acquisitions (acquired_company_id, parent_company_id)",
+    #Name search: trigrams for anything 3 characters or longer, and a
+    #case-insensitive index for LIKE prefixes shorter than that
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS company_names USING fts5(
+        company_name, content='companies', content_rowid='company_id', tokenize='trigram'
+    )""",
+    """
+    CREATE TRIGGER IF NOT EXISTS company_names_insert AFTER INSERT ON companies BEGIN
+        INSERT INTO company_names (rowid, company_name) VALUES (new.company_id, new.company_name);
+    END""",
+    """
+    CREATE TRIGGER IF NOT EXISTS company_names_update AFTER UPDATE OF company_name ON companies BEGIN
+        INSERT INTO company_names (company_names, rowid, company_name) VALUES ('delete', old.company_id, old.company_name);
+        INSERT INTO company_names (rowid, company_name) VALUES (new.company_id, new.company_name);
+    END""",
+    """
+    CREATE TRIGGER IF NOT EXISTS company_names_delete AFTER DELETE ON companies BEGIN
+        INSERT INTO company_names (company_names, rowid, company_name) VALUES ('delete', old.company_id, old.company_name);
+    END""",
+    "CREATE INDEX IF NOT EXISTS companies_by_name ON companies (company_name COLLATE NOCASE)"
+]
+
+#Same fields and order as Company.to_dict
+COMPANY_KEYS = ('company_id', 'company_name', 'headcount', 'current_employee_count', 'past_employee_count',
+                'family_current_employee_count', 'family_past_employee_count')
+COMPANY_COLUMNS = ", ".join(f"c.{key}" for key in COMPANY_KEYS)
+
+def company_dict(row):
+    return dict(zip(COMPANY_KEYS, row))
+
+def chain_cte(name, direction, start, max_depth=MAX_CHAIN_DEPTH):
+    #`name`(company_id, depth) for every company below ('down') or above
+    #('up') the companies selected by `start`, with the number of
+    #acquisitions in between, up to max_depth (a number or a parameter).
+    #A company can appear at several depths
+    if direction == 'down':
+        from_column, to_column = 'parent_company_id', 'acquired_company_id'
+    else:
+        from_column, to_column = 'acquired_company_id', 'parent_company_id'
+    return f"""
+    {name}(company_id, depth) AS (
+        SELECT a.{to_column}, 1 FROM acquisitions a WHERE a.{from_column} IN ({start})
+        UNION
+        SELECT a.{to_column}, chain.depth + 1 FROM acquisitions a JOIN {name} chain ON a.{from_column} = chain.company_id
+        WHERE chain.depth < {max_depth}
+    )"""
+
+def family_cte(include_descendants=False, include_ancestors=False):
+    #Binds family(company_id) to the ids in :company_ids (a json list) plus
+    #their descendants and/or ancestors, like models.family_ids_clause
+    ctes = ["roots(company_id) AS (SELECT value FROM json_each(:company_ids))"]
+    members = ["SELECT company_id FROM roots"]
+    if include_descendants:
+        ctes.append(chain_cte('descendants', 'down', "SELECT company_id FROM roots"))
+        members.append("SELECT company_id FROM descendants")
+    if include_ancestors:
+        ctes.append(chain_cte('ancestors', 'up', "SELECT company_id FROM roots"))
+        members.append("SELECT company_id FROM ancestors")
+    ctes.append(f"family(company_id) AS ({' UNION '.join(members)})")
+    return "WITH RECURSIVE " + ",".join(ctes)
+
+def chain_query(direction):
+    #Companies above/below :company_id, nearest first, and their depths.
+    #Bounded like the Neo4j sections, by :max_depth and :chain_limit
+    return f"""
+    WITH RECURSIVE {chain_cte('chain', direction, ':company_id', ':max_depth')}
+    SELECT nearest.depth, {COMPANY_COLUMNS}
+    FROM (SELECT company_id, min(depth) AS depth FROM chain GROUP BY company_id) nearest
+    JOIN companies c ON c.company_id = nearest.company_id
+    ORDER BY nearest.depth, c.company_id
+    LIMIT :chain_limit
+    """
+
+COMPANY_SECTIONS = {
+    'parent': f"""
+        SELECT {COMPANY_COLUMNS} FROM acquisitions a JOIN companies c ON c.company_id = a.parent_company_id
+        WHERE a.acquired_company_id = :company_id LIMIT 1""",
+    'ancestors': chain_query('up'),
+    'acquisitions': f"""
+        SELECT {COMPANY_COLUMNS} FROM acquisitions a JOIN companies c ON c.company_id = a.acquired_company_id
+        WHERE a.parent_company_id = :company_id""",
+    'descendants': chain_query('down')
+}
+
+class SQLiteRepository(Repository):
+    name = 'sqlite'
+
+    def __init__(self, path, timeout=30, query_timeout=None):
+        self.path = path
+        self.timeout = timeout # Seconds to wait for another writer's lock
+        self.query_timeout = query_timeout # Seconds a read can run, None for no limit
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            #Autocommit, transaction() opens transactions explicitly
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self.local.conn = conn
+        return conn
+
+    def after_fork(self):
+        #SQLite connections can't be carried across a fork
+        self.local = threading.local()
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def query(self, name, sql, params=()):
+        #Timed and row counted under `name` for /metrics, like models.cypher_query.
+        #Outside a transaction it's a read, and gets the query_timeout
+        conn = self.connection()
+        start = time.perf_counter()
+        deadline = None
+        if self.query_timeout and not conn.in_transaction:
+            deadline = start + self.query_timeout
+            conn.set_progress_handler(lambda: time.perf_counter() > deadline, TIMEOUT_CHECK_INSTRUCTIONS)
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        except Exception as e:
+            metrics.sqlite_query_failures.inc(query=name)
+            if deadline is not None and isinstance(e, sqlite3.OperationalError) and str(e) == 'interrupted':
+                metrics.query_timeouts.inc(query=name)
+                raise QueryTimedOut(f"{name} ran longer than {self.query_timeout}s") from e
+            raise
+        finally:
+            if deadline is not None:
+                conn.set_progress_handler(None, 0)
+            metrics.sqlite_query_seconds.observe(time.perf_counter() - start, query=name)
+        metrics.sqlite_query_rows.observe(len(rows), query=name)
+        return rows
+
+    def execute_many(self, name, sql, params):
+        start = time.perf_counter()
+        try:
+            self.connection().executemany(sql, params)
+        except Exception:
+            metrics.sqlite_query_failures.inc(query=name)
+            raise
+        finally:
+            metrics.sqlite_query_seconds.observe(time.perf_counter() - start, query=name)
+
+    def stream(self, name, sql, params=()):
+        start = time.perf_counter()
+        rows = 0
+        for row in self.connection().execute(sql, params):
+            rows += 1
+            yield row
+        metrics.sqlite_query_seconds.observe(time.perf_counter() - start, query=name)
+        metrics.sqlite_query_rows.observe(rows, query=name)
+
+    @contextmanager
+    def transaction(self):
+        #Joins the transaction that's already open, if there is one
+        conn = self.connection()
+        if conn.in_transaction:
+            yield
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def install_schema(self):
+        #Also done by every new connection, the statements are all IF NOT EXISTS.
+        #The name index is rebuilt for companies written before it existed
+        for statement in SCHEMA:
+            self.connection().execute(statement)
+        self.connection().execute("INSERT INTO company_names (company_names) VALUES ('rebuild')")
+
+    def create_companies(self, companies_data):
+        query = """
+        INSERT INTO companies (company_id, company_name, headcount) VALUES (:company_id, :company_name, :headcount)
+        ON CONFLICT (company_id) DO UPDATE SET company_name = excluded.company_name, headcount = excluded.headcount
+        """
+        self.execute_many('SQLite.create_companies', query, companies_data)
+
+    def existing_company_ids(self, company_ids):
+        rows = self.query('SQLite.existing_company_ids',
+                          "SELECT company_id FROM companies WHERE company_id IN (SELECT value FROM json_each(?))",
+                          (json.dumps(list(company_ids)),))
+        return set(row[0] for row in rows)
+
+    def find_employments(self, keys):
+        #{(person_id, company_id, start_date): (employment_title, end_date)}
+        #for the keys that exist, in one query: each key seeks employments_key
+        rows = self.query('SQLite.find_employments', """
+            SELECT e.person_id, e.company_id, e.start_date, e.employment_title, e.end_date
+            FROM json_each(?) k
+            JOIN employments e ON e.person_id = json_extract(k.value, '$[0]')
+                              AND e.company_id = json_extract(k.value, '$[1]')
+                              AND e.start_date IS json_extract(k.value, '$[2]')
+            """, (json.dumps(list(keys)),))
+        return {tuple(row[:3]): tuple(row[3:]) for row in rows}
+
+    def create_employments(self, person_employments_data):
+        #Same rules as Employment.bulk_create: keyed on (person, company,
+        #start_date), the last copy of a record in the batch wins, and
+        #employments at unknown companies are skipped
+        self.execute_many('SQLite.create_people', "INSERT OR IGNORE INTO people (person_id) VALUES (?)",
+                          [(person_id,) for person_id in set(pe['person_id'] for pe in person_employments_data)])
+        employments = {}
+        for pe in person_employments_data:
+            key = (pe['person_id'], pe['company_id'], as_timestamp(pe.get('start_date')))
+            employments[key] = (pe['employment_title'], as_timestamp(pe.get('end_date')))
+        companies = self.existing_company_ids(set(key[1] for key in employments))
+
+        employments = {key: value for key, value in employments.items() if key[1] in companies}
+        found = self.find_employments(employments)
+
+        inserts, updates, changes = [], [], []
+        for key, (employment_title, end_date) in employments.items():
+            existing = found.get(key)
+            if existing is None:
+                inserts.append(key + (employment_title, end_date))
+            else:
+                updates.append((employment_title, end_date) + key)
+            changes.append((key[1], existing is not None, existing is not None and existing[1] is None, end_date is None))
+        self.execute_many('SQLite.create_employments', """
+            INSERT INTO employments (person_id, company_id, start_date, employment_title, end_date) VALUES (?, ?, ?, ?, ?)
+            """, inserts)
+        self.execute_many('SQLite.update_employments', """
+            UPDATE employments SET employment_title = ?, end_date = ?
+            WHERE person_id = ? AND company_id = ? AND start_date IS ?
+            """, updates)
+        self.apply_employee_count_deltas(employee_count_deltas(changes))
+
+    def edit_employments(self, person_employments_data):
+        #Same rules as Employment.bulk_edit. Later edits in the batch see the earlier ones
+        keys = [(pe['person_id'], pe['company_id'], as_timestamp(pe['start_date']) if pe.get('start_date') else None)
+                for pe in person_employments_data]
+        found = self.find_employments(set(keys))
+        edited = {}
+        unmatched, changes = [], []
+        for pe, key in zip(person_employments_data, keys):
+            existing = edited.get(key) or found.get(key)
+            if existing is None:
+                unmatched.append(pe)
+                continue
+            employment_title = pe.get('employment_title') or existing[0]
+            end_date = as_timestamp(pe['end_date']) if pe.get('end_date') else existing[1]
+            edited[key] = (employment_title, end_date)
+            changes.append((key[1], True, existing[1] is None, end_date is None))
+        self.execute_many('SQLite.edit_employments', """
+            UPDATE employments SET employment_title = ?, end_date = ?
+            WHERE person_id = ? AND company_id = ? AND start_date IS ?
+            """, [value + key for key, value in edited.items()])
+        self.apply_employee_count_deltas(employee_count_deltas(changes))
+        return unmatched
+
+    def apply_employee_count_deltas(self, deltas):
+        #Same as Company.apply_employee_count_deltas, with the ancestors from a recursive CTE
+        if not deltas:
+            return
+        self.execute_many('SQLite.apply_employee_count_deltas', """
+            UPDATE companies SET current_employee_count = current_employee_count + :current,
+                                 past_employee_count = past_employee_count + :past
+            WHERE company_id = :company_id
+            """, deltas)
+        self.execute_many('SQLite.apply_employee_count_deltas', f"""
+            WITH RECURSIVE {chain_cte('ancestors', 'up', ':company_id')}
+            UPDATE companies SET family_current_employee_count = family_current_employee_count + :current,
+                                 family_past_employee_count = family_past_employee_count + :past
+            WHERE company_id = :company_id OR company_id IN (SELECT company_id FROM ancestors)
+            """, deltas)
+
+    def refresh_family_counts(self, company_ids=None):
+        #Same as Company.refresh_family_counts
+        if company_ids is None:
+            rows = self.query('SQLite.refresh_family_counts', "SELECT company_id FROM companies")
+        else:
+            rows = self.query('SQLite.refresh_family_counts', family_cte(include_ancestors=True) + """
+                SELECT company_id FROM family JOIN companies USING (company_id)
+                """, {'company_ids': json.dumps(list(company_ids))})
+        self.execute_many('SQLite.refresh_family_counts', f"""
+            WITH RECURSIVE {chain_cte('descendants', 'down', ':company_id')}
+            UPDATE companies SET
+                family_current_employee_count = current_employee_count + (
+                    SELECT coalesce(sum(d.current_employee_count), 0) FROM companies d
+                    WHERE d.company_id IN (SELECT company_id FROM descendants)),
+                family_past_employee_count = past_employee_count + (
+                    SELECT coalesce(sum(d.past_employee_count), 0) FROM companies d
+                    WHERE d.company_id IN (SELECT company_id FROM descendants))
+            WHERE company_id = :company_id
+            """, [{'company_id': row[0]} for row in rows])
+
+    def reachable_pairs(self, company_ids):
+        #(ancestor, descendant) pairs among company_ids, like Acquisition.reachable_pairs
+        rows = self.query('SQLite.reachable_pairs', f"""
+            WITH RECURSIVE roots(company_id) AS (SELECT value FROM json_each(:company_ids)),
+            reach(ancestor_id, company_id, depth) AS (
+                SELECT a.parent_company_id, a.acquired_company_id, 1
+                FROM acquisitions a WHERE a.parent_company_id IN (SELECT company_id FROM roots)
+                UNION
+                SELECT reach.ancestor_id, a.acquired_company_id, reach.depth + 1
+                FROM acquisitions a JOIN reach ON a.parent_company_id = reach.company_id
+                WHERE reach.depth < {MAX_CHAIN_DEPTH}
+            )
+            SELECT DISTINCT ancestor_id, company_id FROM reach
+            WHERE company_id IN (SELECT company_id FROM roots)
+            """, {'company_ids': json.dumps(list(company_ids))})
+        return [tuple(row) for row in rows]
+
+    def create_acquisitions(self, company_acquisitions_data):
+        #Both companies have to exist, like the MATCHes in Acquisition.bulk_create,
+        #and acquisitions that would make a cycle are returned instead.
+        #BEGIN IMMEDIATE holds the write lock from the cycle check to the
+        #family counts, so no other write can land in between and be overwritten
+        with self.transaction():
+            company_acquisitions_data, rejected = acyclic_acquisitions(
+                company_acquisitions_data, self.reachable_pairs(acquisition_company_ids(company_acquisitions_data)))
+            self.execute_many('SQLite.create_acquisitions', """
+                INSERT INTO acquisitions (parent_company_id, acquired_company_id, merged_into_parent_company)
+                SELECT :parent_company_id, :acquired_company_id, :merged_into_parent_company
+                WHERE EXISTS (SELECT 1 FROM companies WHERE company_id = :parent_company_id)
+                  AND EXISTS (SELECT 1 FROM companies WHERE company_id = :acquired_company_id)
+                ON CONFLICT (parent_company_id, acquired_company_id)
+                DO UPDATE SET merged_into_parent_company = excluded.merged_into_parent_company
+                """, [dict(data, merged_into_parent_company=data.get('merged_into_parent_company'))
+                      for data in company_acquisitions_data])
+            self.refresh_family_counts(set(data['parent_company_id'] for data in company_acquisitions_data))
+        return rejected
+
+    def rebuild_acquisitions(self):
+        #There's no stored closure to rebuild, only the family counts built on the chains
+        with self.transaction():
+            self.refresh_family_counts()
+
+    def rebuild_employee_counts(self):
+        with self.transaction():
+            self.query('SQLite.rebuild_employee_counts', """
+                UPDATE companies SET
+                    current_employee_count = (SELECT count(*) FROM employments e
+                                              WHERE e.company_id = companies.company_id AND e.end_date IS NULL),
+                    past_employee_count = (SELECT count(*) FROM employments e
+                                           WHERE e.company_id = companies.company_id AND e.end_date IS NOT NULL)
+                """)
+            self.refresh_family_counts()
+
+    def get_company_data(self, company_ids, sections=(), max_depth=CHAIN_MAX_DEPTH, limit=CHAIN_MAX_RESULTS):
+        #Same payload as Company.get_company_data, one query per id and section
+        company_data = []
+        for company_id in company_ids:
+            params = dict(chain_params(max_depth, limit), company_id=company_id)
+            rows = self.query('SQLite.get_company_data', f"SELECT {COMPANY_COLUMNS} FROM companies c WHERE c.company_id = :company_id", params)
+            if not rows:
+                continue
+            data = {'company': company_dict(rows[0])}
+            for section in sections:
+                rows = self.query(f'SQLite.get_company_data.{section}', COMPANY_SECTIONS[section], params)
+                if section == 'parent':
+                    data[section] = company_dict(rows[0]) if rows else None
+                elif section in CHAIN_SECTIONS:
+                    data[section] = [dict(company_dict(row[1:]), depth=row[0]) for row in rows]
+                else:
+                    data[section] = [company_dict(row) for row in rows]
+            company_data.append(bound_chains(data, max_depth, limit))
+        return company_data
+
+    def company_page(self, after=None, limit=None):
+        query, params = keyset_page_query(f"SELECT {COMPANY_COLUMNS} FROM companies c", "c.company_id",
+                                          "ORDER BY c.company_id", after, limit)
+        return [company_dict(row) for row in self.query('SQLite.company_page', query, params)]
+
+    def people_page(self, after=None, limit=None):
+        query, params = keyset_page_query("SELECT person_id FROM people", "person_id", "ORDER BY person_id", after, limit)
+        return [{'person_id': row[0]} for row in self.query('SQLite.people_page', query, params)]
+
+    def stream_companies(self):
+        query = f"SELECT {COMPANY_COLUMNS} FROM companies c ORDER BY c.company_id"
+        return (company_dict(row) for row in self.stream('SQLite.stream_companies', query))
+
+    def stream_people(self):
+        query = "SELECT person_id FROM people ORDER BY person_id"
+        return ({'person_id': row[0]} for row in self.stream('SQLite.stream_people', query))
+
+    def acquisition_chain_ids(self, company_ids):
+        rows = self.query('SQLite.acquisition_chain_ids', family_cte(True, True) + """
+            SELECT company_id FROM family JOIN companies USING (company_id)
+            """, {'company_ids': json.dumps(list(company_ids))})
+        return set(row[0] for row in rows)
+
+    def search_companies(self, query, limit=10):
+        match = fts5_query(query)
+        if match:
+            candidates = self.query('SQLite.search_companies', f"""
+                SELECT {COMPANY_COLUMNS} FROM company_names
+                JOIN companies c ON c.company_id = company_names.rowid
+                WHERE company_names MATCH :match
+                ORDER BY company_names.rank LIMIT :limit
+                """, {'match': match, 'limit': candidate_limit(limit)})
+            if len(candidates) < limit:
+                #Typos: names sharing any trigram, read in rowid order up to
+                #MAX_TYPO_CANDIDATES rather than ranking every one of them
+                candidates += self.query('SQLite.search_companies', f"""
+                    SELECT {COMPANY_COLUMNS} FROM companies c
+                    WHERE c.company_id IN (
+                        SELECT rowid FROM company_names WHERE company_names MATCH :match LIMIT :scan)
+                    """, {'match': fts5_query(query, require_all=False), 'scan': MAX_TYPO_CANDIDATES})
+                candidates = list({row[0]: row for row in candidates}.values())
+        else:
+            candidates = self.query('SQLite.search_companies', f"""
+                SELECT {COMPANY_COLUMNS} FROM companies c
+                WHERE c.company_name LIKE :prefix ESCAPE '\\'
+                ORDER BY length(c.company_name) LIMIT :limit
+                """, {'prefix': like_prefix(query), 'limit': candidate_limit(limit)})
+        return rank_companies(query, [company_dict(row) for row in candidates], limit)
+
+    def employment_rows(self, company_ids, past=False, present=False,
+                        include_descendants=False, include_ancestors=False, period=None):
+        #Same rows as Person.get_employment_rows_in_companies
+        query = family_cte(include_descendants, include_ancestors) + """
+            SELECT e.person_id, c.company_name, e.employment_title
+            FROM family f
+            JOIN companies c ON c.company_id = f.company_id
+            JOIN employments e ON e.company_id = f.company_id
+            WHERE 1 = 1""" + employment_end_filter(past, present)
+        params = {'company_ids': json.dumps(list(company_ids))}
+        if period is not None:
+            query += """
+              AND e.start_date <= :period_end
+              AND (e.end_date IS NULL OR :period_start IS NULL OR e.end_date >= :period_start)"""
+            params['period_start'], params['period_end'] = period
+        return [EmploymentRow(*row) for row in self.query('SQLite.employment_rows', query, params)]
+
+    def stream_acquisitions(self):
+        return self.stream('SQLite.stream_acquisitions', "SELECT parent_company_id, acquired_company_id FROM acquisitions")
+
+    def stream_employments(self):
+        return self.stream('SQLite.stream_employments', """
+            SELECT company_id, person_id, start_date, employment_title, end_date FROM employments
+            """)
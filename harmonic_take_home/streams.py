@@ -0,0 +1,138 @@
+import os
+import socket
+import time
+import redis
+from harmonic_take_home.ingest import MalformedMessage
+
+STREAM_NAME = 'flask_stream'
+GROUP_NAME = 'flask_group'
+DEAD_LETTER_STREAM = 'flask_stream:dead'
+
+def consumer_name():
+    #One consumer per worker process, so the name has to be unique per process
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def ensure_consumer_group(redis_conn, stream_name=STREAM_NAME, group_name=GROUP_NAME):
+    #id='0' so a brand new group also picks up anything published
+    #before the first worker started
+    try:
+        redis_conn.xgroup_create(stream_name, group_name, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+#Messages are stored under a single 'data' field, holding the same
+#json string that used to be sent over Pub/Sub
+class StreamConsumer:
+    def __init__(self, redis_conn, handler=None, stream_name=STREAM_NAME, group_name=GROUP_NAME,
+                 name=None, batch_size=100, block_ms=1000, claim_idle_ms=60000, max_deliveries=5,
+                 writer=None):
+        # handler is called with the raw json message, and must return True
+        # once the write is committed; only then is the entry XACKed.
+        # If a BatchWriter is passed in instead, messages are buffered in it
+        # and entries are acked as the writer commits them. Either one raises
+        # MalformedMessage for entries that can't ever be applied, which go
+        # straight to the dead letter stream
+        self.redis_conn = redis_conn
+        self.handler = handler
+        self.writer = writer
+        self.stream_name = stream_name
+        self.group_name = group_name
+        self.name = name or consumer_name()
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.running = False
+        self.last_claim = 0
+        self.acked_total = 0
+
+    def read(self):
+        block_ms = self.block_ms
+        if self.writer:
+            #Don't block past the writer's flush deadline
+            block_ms = min(block_ms, int(self.writer.max_delay * 1000))
+        response = self.redis_conn.xreadgroup(
+            self.group_name, self.name, {self.stream_name: '>'},
+            count=self.batch_size, block=block_ms)
+        if not response:
+            return []
+        return response[0][1]
+
+    def reclaim(self):
+        #Takes over entries that another consumer read but never acked
+        #(i.e. the worker died mid batch). Entries that keep failing are
+        #moved to the dead letter stream so they can't block the group forever
+        pending = self.redis_conn.xpending_range(
+            self.stream_name, self.group_name, '-', '+', self.batch_size, idle=self.claim_idle_ms)
+        claim_ids = []
+        dead_ids = []
+        for entry in pending:
+            if entry['times_delivered'] >= self.max_deliveries:
+                dead_ids.append(entry['message_id'])
+            else:
+                claim_ids.append(entry['message_id'])
+
+        if dead_ids:
+            entries = [(entry_id, fields) for entry_id, fields
+                       in self.redis_conn.xrange(self.stream_name, min=dead_ids[0], max=dead_ids[-1])
+                       if entry_id in dead_ids]
+            self.dead_letter(entries, f"Failed {self.max_deliveries} deliveries")
+            self.ack(dead_ids)
+
+        if not claim_ids:
+            return []
+        return self.redis_conn.xclaim(
+            self.stream_name, self.group_name, self.name, self.claim_idle_ms, claim_ids)
+
+    def dead_letter(self, entries, reason):
+        #Callers ack the entries once they're copied
+        for entry_id, fields in entries:
+            self.redis_conn.xadd(DEAD_LETTER_STREAM, {'id': entry_id, 'reason': reason, **fields})
+
+    def ack(self, entry_ids):
+        if entry_ids:
+            self.redis_conn.xack(self.stream_name, self.group_name, *entry_ids)
+
+    def process(self, entries):
+        #Entries deleted from the stream come back from XCLAIM without fields,
+        #there's nothing left to apply so they just get acked
+        acked = []
+        for entry_id, fields in entries:
+            if not fields:
+                acked.append(entry_id)
+                continue
+            try:
+                if self.writer:
+                    acked.extend(self.writer.add(fields.get('data'), entry_id))
+                elif self.handler(fields.get('data')):
+                    acked.append(entry_id)
+            except MalformedMessage as e:
+                print(f"Dead lettering {entry_id}: {e}")
+                self.dead_letter([(entry_id, fields)], str(e))
+                acked.append(entry_id)
+        if self.writer:
+            acked.extend(self.writer.flush_due())
+        self.ack(acked)
+        self.acked_total += len(acked)
+        return acked
+
+    def run_once(self):
+        now = time.time()
+        if (now - self.last_claim) * 1000 >= self.claim_idle_ms:
+            self.last_claim = now
+            self.process(self.reclaim())
+        return self.process(self.read())
+
+    def run(self):
+        ensure_consumer_group(self.redis_conn, self.stream_name, self.group_name)
+        self.running = True
+        while self.running:
+            self.run_once()
+        if self.writer:
+            drained = self.writer.flush_all()
+            self.ack(drained)
+            self.acked_total += len(drained)
+
+    def stop(self):
+        self.running = False
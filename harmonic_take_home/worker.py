@@ -0,0 +1,171 @@
+import json
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from harmonic_take_home import metrics
+from harmonic_take_home.batch_writer import PartitionedWriter
+from harmonic_take_home.streams import StreamConsumer, ensure_consumer_group, consumer_name
+
+#Runs the stream consumers in their own process (`flask ingest-worker`),
+#so web workers only ever serve reads.
+#
+#Each process is one consumer in the group. Its records are split between
+#`threads` writer partitions by person/company (see PartitionedWriter), so
+#a hire and the edits to it are always written in order by the same thread.
+#Several worker processes split the stream between them and that ordering
+#no longer holds across them, so scale with --threads where it matters.
+#A consumer thread that dies is restarted on the next heartbeat; what it
+#hadn't acked is still pending under its name and is picked up again.
+#
+#Every consumer writes a heartbeat to the WORKERS_KEY hash, which
+#/ingest/health reads along with the group's pending count and lag
+
+WORKERS_KEY = 'ingest:workers'
+
+def build_consumer(app_config, redis_conn, name=None, partitions=1):
+    writer = PartitionedWriter(
+        partitions=partitions,
+        batch_size=app_config['WRITER_BATCH_SIZE'],
+        min_batch_size=app_config['WRITER_MIN_BATCH_SIZE'],
+        max_batch_size=app_config['WRITER_MAX_BATCH_SIZE'],
+        batch_step=app_config['WRITER_BATCH_STEP'],
+        max_delay=app_config['WRITER_MAX_DELAY'],
+        target_latency=app_config['WRITER_TARGET_LATENCY'])
+    return StreamConsumer(
+        redis_conn,
+        writer=writer,
+        stream_name=app_config['STREAM_NAME'],
+        group_name=app_config['STREAM_GROUP'],
+        name=name,
+        batch_size=app_config['STREAM_BATCH_SIZE'],
+        block_ms=app_config['STREAM_BLOCK_MS'],
+        claim_idle_ms=app_config['STREAM_CLAIM_IDLE_MS'])
+
+class IngestWorker:
+    def __init__(self, app_config, redis_conn, threads=1, heartbeat_interval=5):
+        self.redis_conn = redis_conn
+        self.heartbeat_interval = heartbeat_interval
+        self.stream_name = app_config['STREAM_NAME']
+        self.group_name = app_config['STREAM_GROUP']
+        self.consumers = [build_consumer(app_config, redis_conn, consumer_name(), partitions=threads)]
+        self.threads = []
+        self.stopping = threading.Event()
+        self.started = None
+
+    def consumer_status(self, consumer, thread):
+        return {
+            'heartbeat': time.time(),
+            'started': self.started,
+            'alive': thread.is_alive(),
+            'acked': consumer.acked_total,
+            'buffered': consumer.writer.pending(),
+            'batch_size': [writer.batch_size for writer in consumer.writer.writers],
+            'stopping': self.stopping.is_set()
+        }
+
+    def heartbeat(self):
+        statuses = {consumer.name: json.dumps(self.consumer_status(consumer, thread))
+                    for consumer, thread in zip(self.consumers, self.threads)}
+        self.redis_conn.hset(WORKERS_KEY, mapping=statuses)
+
+    def run_consumer(self, consumer):
+        try:
+            consumer.run()
+        except Exception as e:
+            #Anything un-acked stays pending, and run() restarts the thread
+            print(f"Consumer {consumer.name} stopped: {e}")
+
+    def start_consumer(self, consumer):
+        thread = threading.Thread(target=self.run_consumer, args=(consumer,), name=consumer.name)
+        thread.start()
+        return thread
+
+    def start(self):
+        ensure_consumer_group(self.redis_conn, self.stream_name, self.group_name)
+        self.started = time.time()
+        self.threads = [self.start_consumer(consumer) for consumer in self.consumers]
+
+    def restart_dead(self):
+        for i, (consumer, thread) in enumerate(zip(self.consumers, self.threads)):
+            if not thread.is_alive() and not self.stopping.is_set():
+                print(f"Restarting consumer {consumer.name}")
+                metrics.ingest_consumer_restarts.inc()
+                self.threads[i] = self.start_consumer(consumer)
+
+    def stop(self, *args):
+        #Consumers finish the read they're in, flush what they've buffered
+        #and ack it before their thread exits
+        if not self.stopping.is_set():
+            print("Stopping ingest worker, draining buffered writes")
+        self.stopping.set()
+        for consumer in self.consumers:
+            consumer.stop()
+
+    def run(self):
+        #Blocks until every consumer has drained, heartbeating meanwhile.
+        #SIGTERM/SIGINT stop the worker gracefully
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.start()
+        while any(thread.is_alive() for thread in self.threads):
+            self.heartbeat()
+            self.restart_dead()
+            self.stopping.wait(self.heartbeat_interval)
+            if self.stopping.is_set():
+                for thread in self.threads:
+                    thread.join()
+        self.redis_conn.hdel(WORKERS_KEY, *[consumer.name for consumer in self.consumers])
+
+def ingest_health(redis_conn, stream_name, group_name, stale_after):
+    #Pending = delivered but not acked yet, lag = not delivered yet
+    #(lag needs Redis 7, it's None before that)
+    group = {}
+    try:
+        for info in redis_conn.xinfo_groups(stream_name):
+            if info['name'] == group_name:
+                group = info
+    except Exception as e:
+        print(e)
+    oldest_pending_ms = None
+    if group.get('pending'):
+        oldest = redis_conn.xpending_range(stream_name, group_name, '-', '+', 1)
+        if oldest:
+            oldest_pending_ms = oldest[0]['time_since_delivered']
+
+    now = time.time()
+    consumers = {}
+    for name, status in redis_conn.hgetall(WORKERS_KEY).items():
+        status = json.loads(status)
+        status['heartbeat_age'] = now - status['heartbeat']
+        status['live'] = status['alive'] and status['heartbeat_age'] <= stale_after
+        consumers[name] = status
+
+    return {
+        'healthy': any(status['live'] for status in consumers.values()),
+        'stream': stream_name,
+        'group': group_name,
+        'pending': group.get('pending'),
+        'lag': group.get('lag'),
+        'last_delivered_id': group.get('last-delivered-id'),
+        'oldest_pending_ms': oldest_pending_ms,
+        'consumers': consumers
+    }
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(port):
+    #The worker doesn't run Flask, so its ingest metrics get their own port
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,47 @@
+import argparse
+import json
+import time
+from harmonic_take_home.models import Company, Person
+
+# Compares the /people read paths, from the query to the dicts that get
+# serialized: inflating Person nodes vs the projected EmploymentRow path.
+# Run against a populated db, e.g.
+#   python inflate_benchmark.py --company-ids "[2001628, 3205143]" --repeat 20
+
+def inflate_path(company_ids):
+    people = Person.get_employees_in_companies(company_ids)
+    return [{'person_id': person['person'].person_id, 'company_name': person['company_name'], 'employment_title': person['employment_title']} for person in people]
+
+def projection_path(company_ids):
+    return [row.to_dict() for row in Person.get_employment_rows_in_companies(company_ids)]
+
+def measure(path, company_ids, repeat):
+    rows = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        rows += len(path(company_ids))
+    elapsed = time.perf_counter() - start
+    return rows, elapsed
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--company-ids', help="json list of company ids, defaults to every company")
+parser.add_argument('--repeat', type=int, default=10)
+args = parser.parse_args()
+
+if args.company_ids:
+    company_ids = json.loads(args.company_ids)
+else:
+    company_ids = [company['company_id'] for company in Company.get_page()]
+
+# Warm up the connection and the query caches first
+projection_path(company_ids)
+inflate_path(company_ids)
+
+results = {}
+for name, path in [('inflate', inflate_path), ('projection', projection_path)]:
+    rows, elapsed = measure(path, company_ids, args.repeat)
+    results[name] = {'rows': rows, 'seconds': elapsed, 'rows_per_second': rows / elapsed if elapsed else None}
+    print(f"{name:>10}: {rows} rows in {elapsed:.3f}s ({results[name]['rows_per_second']:.0f} rows/s)")
+
+if results['inflate']['rows_per_second']:
+    print(f"projection speedup: {results['projection']['rows_per_second'] / results['inflate']['rows_per_second']:.2f}x")
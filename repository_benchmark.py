@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import random
+import time
+from harmonic_take_home.repository import Neo4jRepository
+from harmonic_take_home.sqlite_repository import SQLiteRepository
+from benchmark import INGEST_ORDER, load, summarize
+
+# Compares the storage backends on the same data, without Flask or Redis in
+# the way: ingest records/sec per message type, then the latency of each
+# repository read the routes make. e.g.
+#   python data_generator.py --output-dir data/large
+#   python repository_benchmark.py --data-dir data/large --output bench_results_repository.json
+#
+# PLEASE NOTE -- ingest writes the dataset into the configured Neo4j db,
+# and into a fresh SQLite file at --sqlite-path (any file already there is
+# deleted first, unless --skip-ingest)
+
+SECTIONS = ['parent', 'ancestors', 'acquisitions', 'descendants']
+
+def benchmark_ingest(repository, data_dir, chunk_size):
+    apply = {
+        'companies': repository.create_companies,
+        'person_employments': repository.create_employments,
+        'company_acquisitions': repository.create_acquisitions
+    }
+    results = {}
+    for data_type, file_name in INGEST_ORDER:
+        records = load(data_dir, file_name)
+        start = time.perf_counter()
+        for i in range(0, len(records), chunk_size):
+            with repository.transaction():
+                apply[data_type](records[i:i + chunk_size])
+        elapsed = time.perf_counter() - start
+        results[data_type] = {
+            'records': len(records),
+            'seconds': elapsed,
+            'records_per_second': len(records) / elapsed if elapsed else None
+        }
+        print(f"{repository.name} ingest {data_type}: {results[data_type]['records_per_second']:.0f} records/s")
+    return results
+
+def read_operations(repository, company_ids, rng):
+    # (name, call) -- one per benchmarked read
+    def some_ids(n):
+        return rng.sample(company_ids, min(n, len(company_ids)))
+    company_id = rng.choice(company_ids)
+    return [
+        ('company', lambda: repository.get_company_data([company_id])),
+        ('company all sections', lambda: repository.get_company_data([company_id], SECTIONS)),
+        ('company page', lambda: repository.company_page(limit=100)),
+        ('employment rows', lambda: repository.employment_rows(some_ids(10))),
+        ('employment rows present', lambda: repository.employment_rows(some_ids(10), present=True)),
+        ('employment rows descendants', lambda: repository.employment_rows(some_ids(10), include_descendants=True)),
+        ('acquisition chain ids', lambda: repository.acquisition_chain_ids(some_ids(10)))
+    ]
+
+def benchmark_reads(repository, company_ids, repeat, seed):
+    # Same seed for every backend, so they answer the same requests
+    rng = random.Random(seed)
+    latencies = {}
+    for _ in range(repeat):
+        for name, call in read_operations(repository, company_ids, rng):
+            start = time.perf_counter()
+            call()
+            latencies.setdefault(name, []).append(time.perf_counter() - start)
+    results = {}
+    for name, operation_latencies in latencies.items():
+        results[name] = summarize(operation_latencies)
+        print(f"{repository.name} {name}: p50 {results[name]['p50_ms']:.2f}ms p99 {results[name]['p99_ms']:.2f}ms")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-dir', default='.')
+    parser.add_argument('--backends', default='neo4j,sqlite')
+    parser.add_argument('--sqlite-path', default='bench.sqlite3')
+    parser.add_argument('--chunk-size', type=int, default=1000, help="records per transaction")
+    parser.add_argument('--skip-ingest', action='store_true', help="only benchmark the reads")
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results_repository.json')
+    args = parser.parse_args()
+
+    def fresh_sqlite():
+        if not args.skip_ingest:
+            for path in [args.sqlite_path, args.sqlite_path + '-wal', args.sqlite_path + '-shm']:
+                if os.path.exists(path):
+                    os.remove(path)
+        return SQLiteRepository(args.sqlite_path)
+
+    repositories = {'neo4j': Neo4jRepository, 'sqlite': fresh_sqlite}
+    company_ids = [company['company_id'] for company in load(args.data_dir, 'Companies.json')]
+    results = {'params': vars(args)}
+    for backend in args.backends.split(','):
+        repository = repositories[backend]()
+        results[backend] = {}
+        if not args.skip_ingest:
+            results[backend]['ingest'] = benchmark_ingest(repository, args.data_dir, args.chunk_size)
+        results[backend]['reads'] = benchmark_reads(repository, company_ids, args.repeat, args.seed)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
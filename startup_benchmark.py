@@ -0,0 +1,70 @@
+import argparse
+import datetime
+import json
+import subprocess
+import sys
+from benchmark import summarize, git_commit
+
+# Measures how long a fresh worker process takes to serve: importing the
+# package, create_app, and the first request (which is when the db and
+# Redis connections are opened). Each run is a new interpreter so nothing
+# is already imported or connected. e.g.
+#   python startup_benchmark.py --path /company/703504 --output bench_results_startup.json
+#   python startup_benchmark.py --config '{"STORAGE_BACKEND": "sqlite"}'
+
+PHASES = ['import', 'create_app', 'first_request', 'second_request']
+
+RUN = """
+import json, sys, time
+start = time.perf_counter()
+from harmonic_take_home import create_app
+imported = time.perf_counter()
+app = create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+client = app.test_client()
+status = client.get(sys.argv[2]).status_code
+first = time.perf_counter()
+client.get(sys.argv[2])
+second = time.perf_counter()
+print(json.dumps({'status': status, 'import': imported - start, 'create_app': created - imported,
+                  'first_request': first - created, 'second_request': second - first}))
+"""
+
+def run_once(config, path):
+    output = subprocess.check_output([sys.executable, '-c', RUN, json.dumps(config), path], text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+def benchmark_startup(config, path, repeat):
+    timings = {phase: [] for phase in PHASES}
+    totals = []
+    statuses = {}
+    for _ in range(repeat):
+        run = run_once(config, path)
+        statuses[run['status']] = statuses.get(run['status'], 0) + 1
+        for phase in PHASES:
+            timings[phase].append(run[phase])
+        totals.append(run['import'] + run['create_app'] + run['first_request'])
+    results = {phase: summarize(timings[phase]) for phase in PHASES}
+    results['import_to_first_response'] = summarize(totals)
+    results['statuses'] = statuses
+    for name in PHASES + ['import_to_first_response']:
+        print(f"{name}: p50 {results[name]['p50_ms']:.1f}ms p95 {results[name]['p95_ms']:.1f}ms")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default='/', help="route the first request goes to")
+    parser.add_argument('--config', default='{}', help="json passed to create_app")
+    parser.add_argument('--repeat', type=int, default=20, help="fresh processes to start")
+    parser.add_argument('--output', default='bench_results_startup.json')
+    args = parser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'params': vars(args),
+        'startup': benchmark_startup(json.loads(args.config), args.path, args.repeat)
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
@@ -1,12 +1,28 @@
-import redis
+import argparse
 import json
+import multiprocessing
+import queue
+import random
+import threading
 import time
 import datetime
-import random
+import urllib.request
+import urllib.parse
+import redis
+from benchmark import percentile
 
-redis_conn = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+# Load generator for the ingest stream. e.g.
+#   python stream_mimicker.py --rate 500 --duration 60 --processes 4 --mix hires=0.7,edits=0.25,acquisitions=0.05
+#
+# Messages are sent on an open-loop schedule: message i of a producer is due
+# at start + i / rate no matter how long earlier sends took, so a slow
+# consumer (or a slow producer) shows up as lag instead of a lower rate.
+#
+# A sample of hires is also watched through /people until it shows up,
+# which gives the publish-to-visible (freshness) latency of ingest
 
-new_people = []
+# Must match STREAM_NAME in the app config
+stream_name = 'flask_stream'
 
 # Company Ids for LinkedIn, Microsoft and Lynda
 company_ids = [3278851,3205143, 2001628]
@@ -33,44 +49,193 @@ job_titles = [
     'Full Stack Magician',
     'Global Talent Acquisition Ninja'
 ]
-start_time = time.time()
 
 def current_timestamp():
     timestamp_obj = datetime.datetime.fromtimestamp(time.time())
     return timestamp_obj.strftime("%Y-%m-%d %H:%M:%S")
 
-while(time.time() - start_time < 30):
-    time.sleep(random.random())
-
-    person_employment_data = {
-		"company_id": company_ids[random.randint(0,2)],
-		"person_id": random.randint(1000000, 9999999),
-		"employment_title": job_titles[random.randint(0, 19)],
-		"start_date": current_timestamp()
-	}
-    print(person_employment_data)
-    new_people.append(person_employment_data)
-    person_employments_create_data = {
-        "type": "person_employments",
-        "data": [person_employment_data]
-    }
+def parse_mix(mix):
+    weights = {'hires': 0, 'edits': 0, 'acquisitions': 0}
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        if kind not in weights:
+            raise ValueError(f"Unknown message kind in --mix: {kind}")
+        weights[kind] = float(weight)
+    return weights
 
-    stringified_data = json.dumps(person_employments_create_data)
-    redis_conn.publish('flask_channel', stringified_data)
+class Producer:
+    def __init__(self, args, index, freshness_queue):
+        self.args = args
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.redis_conn = redis.Redis.from_url(args.redis_url, decode_responses=True)
+        self.freshness_queue = freshness_queue
+        self.weights = parse_mix(args.mix)
+        self.hired = []
 
+    def hire(self):
+        person_employment_data = {
+            "company_id": self.rng.choice(self.args.company_ids),
+            "person_id": self.rng.randint(1000000, 9999999),
+            "employment_title": self.rng.choice(job_titles),
+            "start_date": current_timestamp()
+        }
+        self.hired.append(person_employment_data)
+        return "person_employments", [person_employment_data]
 
-while(len(new_people) > 0):
-    person_employment_data = new_people.pop(random.randint(0, len(new_people) -1))
-    print("About to fire:")
-    print(person_employment_data)
-    person_employment_data['end_date'] = current_timestamp()
+    def fire(self):
+        person_employment_data = self.hired.pop(self.rng.randrange(len(self.hired)))
+        person_employment_data['end_date'] = current_timestamp()
+        return "person_employments_edit", [person_employment_data]
 
-    person_employments_create_data = {
-        "type": "person_employments_edit",
-        "data": person_employment_data
-    }
+    def acquire(self):
+        parent_company_id, acquired_company_id = self.rng.sample(self.args.company_ids, 2)
+        return "company_acquisitions", [{
+            "parent_company_id": parent_company_id,
+            "acquired_company_id": acquired_company_id,
+            "merged_into_parent_company": self.rng.random() < 0.5
+        }]
+
+    def next_message(self):
+        kind = self.rng.choices(list(self.weights), weights=list(self.weights.values()))[0]
+        if kind == 'edits' and self.hired:
+            return self.fire()
+        if kind == 'acquisitions' and len(self.args.company_ids) > 1:
+            return self.acquire()
+        return self.hire()
+
+    def run(self):
+        interval = self.args.processes / self.args.rate
+        start = time.monotonic()
+        sent = 0
+        max_lag = 0
+        counts = {}
+        while True:
+            due = start + sent * interval
+            if due - start >= self.args.duration:
+                break
+            now = time.monotonic()
+            if due > now:
+                time.sleep(due - now)
+            else:
+                max_lag = max(max_lag, now - due)
+
+            data_type, data = self.next_message()
+            self.redis_conn.xadd(stream_name, {'data': json.dumps({"type": data_type, "data": data})})
+            published = time.time()
+            sent += 1
+            counts[data_type] = counts.get(data_type, 0) + 1
+            if data_type == "person_employments" and self.rng.random() < self.args.freshness_sample:
+                self.freshness_queue.put((data[0]['company_id'], data[0]['person_id'], published))
+
+        return {'sent': sent, 'seconds': time.monotonic() - start, 'max_schedule_lag': max_lag, 'counts': counts}
 
-    stringified_data = json.dumps(person_employments_create_data)
-    redis_conn.publish('flask_channel', stringified_data)
-    time.sleep(random.random())
+def run_producer(args, index, freshness_queue, results_queue):
+    results_queue.put(Producer(args, index, freshness_queue).run())
 
+def employee_ids(api_url, company_id):
+    # Past and present, so a hire that's fired before it's first seen still counts
+    query = urllib.parse.urlencode({'company_ids': json.dumps([company_id])})
+    with urllib.request.urlopen(f"{api_url}/people?{query}", timeout=5) as response:
+        return set(person['person_id'] for person in json.loads(response.read()))
+
+def watch_freshness(args, freshness_queue, latencies, timeouts, done):
+    # Every poll round checks all the sampled hires that aren't visible yet,
+    # with one /people request per company, so a backlog of samples doesn't
+    # add its own wait to the measured latency
+    pending = []
+    while not (done.is_set() and freshness_queue.empty() and not pending):
+        try:
+            while True:
+                pending.append(freshness_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        by_company = {}
+        for sample in pending:
+            by_company.setdefault(sample[0], []).append(sample)
+        still_pending = []
+        for company_id, samples in by_company.items():
+            try:
+                visible = employee_ids(args.api_url, company_id)
+            except Exception as e:
+                print(e)
+                visible = set()
+            seen = time.time()
+            for sample in samples:
+                company_id, person_id, published = sample
+                if person_id in visible:
+                    latencies.append(seen - published)
+                elif seen - published > args.freshness_timeout:
+                    timeouts.append((company_id, person_id))
+                else:
+                    still_pending.append(sample)
+        pending = still_pending
+        time.sleep(args.poll_interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=float, default=2.0, help="messages per second, across all producers")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds")
+    parser.add_argument('--processes', type=int, default=1, help="producer processes")
+    parser.add_argument('--mix', default='hires=0.7,edits=0.3,acquisitions=0', help="relative weights of hires, edits and acquisitions")
+    parser.add_argument('--companies-file', help="pick companies from this Companies.json instead of LinkedIn/Microsoft/Lynda")
+    parser.add_argument('--freshness-sample', type=float, default=0.05, help="share of hires watched through /people")
+    parser.add_argument('--freshness-timeout', type=float, default=30.0)
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--api-url', default='http://localhost:5001')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/0')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the summary as json")
+    args = parser.parse_args()
+
+    if args.companies_file:
+        with open(args.companies_file) as f:
+            args.company_ids = [company['company_id'] for company in json.load(f)]
+    else:
+        args.company_ids = company_ids
+
+    freshness_queue = multiprocessing.Queue()
+    results_queue = multiprocessing.Queue()
+    producers = [multiprocessing.Process(target=run_producer, args=(args, i, freshness_queue, results_queue))
+                 for i in range(args.processes)]
+    for producer in producers:
+        producer.start()
+
+    latencies = []
+    timeouts = []
+    done = threading.Event()
+    watcher = threading.Thread(target=watch_freshness, args=(args, freshness_queue, latencies, timeouts, done))
+    watcher.start()
+
+    producer_results = [results_queue.get() for _ in producers]
+    for producer in producers:
+        producer.join()
+    done.set()
+    watcher.join()
+
+    sent = sum(result['sent'] for result in producer_results)
+    seconds = max(result['seconds'] for result in producer_results)
+    counts = {}
+    for result in producer_results:
+        for data_type, count in result['counts'].items():
+            counts[data_type] = counts.get(data_type, 0) + count
+    latencies.sort()
+    summary = {
+        'sent': sent,
+        'target_rate': args.rate,
+        'achieved_rate': sent / seconds if seconds else None,
+        'max_schedule_lag_seconds': max(result['max_schedule_lag'] for result in producer_results),
+        'messages': counts,
+        'freshness': {
+            'samples': len(latencies),
+            'timeouts': len(timeouts),
+            'p50_seconds': percentile(latencies, 50),
+            'p95_seconds': percentile(latencies, 95),
+            'p99_seconds': percentile(latencies, 99),
+            'max_seconds': latencies[-1] if latencies else None
+        }
+    }
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)